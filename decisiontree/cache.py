@@ -0,0 +1,185 @@
+import json
+import mmap
+import struct
+
+from array import array
+
+from decisiontree import profiling
+from decisiontree.utils import (CHUNK_SIZE, get_array_typecode,
+                                get_source_signature, read_encoded_columns,
+                                replace_file)
+
+CACHE_SUFFIX = '.cache'
+CACHE_MAGIC = b'DTCACHE1'
+CACHE_VERSION = 2
+CACHE_ALIGNMENT = 8
+HEADER_LENGTH_FORMAT = '<Q'
+
+
+def get_cache_file_name(file_name):
+    return file_name + CACHE_SUFFIX
+
+
+def _align(offset):
+    return (offset + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+
+def _get_load_options(numeric_indexes=(), exclude_flag=None):
+    return {
+        'numeric_indexes': sorted(numeric_indexes),
+        'exclude_flag': exclude_flag,
+    }
+
+
+def write_dataset_cache(file_name, vocabularies, columns,
+                        cache_file_name=None, numeric_indexes=(),
+                        exclude_flag=None):
+    if cache_file_name is None:
+        cache_file_name = get_cache_file_name(file_name)
+    columns_header = []
+    offset = 0
+    for vocabulary, column in zip(vocabularies, columns):
+        if vocabulary is None:
+            column = array('d', column)
+        else:
+            column = array(get_array_typecode(len(vocabulary)), column)
+        columns_header.append({
+            'typecode': column.typecode,
+            'offset': offset,
+            'vocabulary': vocabulary,
+        })
+        offset = _align(offset + len(column) * column.itemsize)
+    header = json.dumps({
+        'version': CACHE_VERSION,
+        'source': get_source_signature(file_name),
+        'options': _get_load_options(numeric_indexes, exclude_flag),
+        'rows': len(columns[0]) if columns else 0,
+        'columns': columns_header,
+    }).encode('utf-8')
+    data_start = _align(
+        len(CACHE_MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT) + len(header)
+    )
+    with replace_file(cache_file_name) as cache_file:
+        cache_file.write(CACHE_MAGIC)
+        cache_file.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)))
+        cache_file.write(header)
+        for column_header, column in zip(columns_header, columns):
+            cache_file.seek(data_start + column_header['offset'])
+            array(column_header['typecode'], column).tofile(cache_file)
+        cache_file.truncate(data_start + offset)
+
+
+def _read_cache_header(cache_view):
+    header_start = len(CACHE_MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT)
+    if bytes(cache_view[:len(CACHE_MAGIC)]) != CACHE_MAGIC:
+        return None, None
+    header_length, = struct.unpack_from(
+        HEADER_LENGTH_FORMAT, cache_view, len(CACHE_MAGIC)
+    )
+    header = json.loads(
+        bytes(cache_view[header_start:header_start + header_length])
+    )
+    return header, _align(header_start + header_length)
+
+
+def read_dataset_cache(file_name, cache_file_name=None, numeric_indexes=(),
+                       exclude_flag=None):
+    # Columns are zero-copy views over a read-only mapping, so processes
+    # opening the same cache share its pages. Returns None when the cache
+    # is missing, damaged or was built from a different version of
+    # file_name or with different load options.
+    if cache_file_name is None:
+        cache_file_name = get_cache_file_name(file_name)
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            cache_map = mmap.mmap(
+                cache_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+    except (OSError, ValueError):
+        return None
+    cache_view = memoryview(cache_map)
+    profiling.count('bytes_mapped', len(cache_view))
+    try:
+        header, data_start = _read_cache_header(cache_view)
+        if (header is None or header['version'] != CACHE_VERSION
+                or header['source'] != get_source_signature(file_name)
+                or header['options'] != _get_load_options(
+                    numeric_indexes, exclude_flag
+                )):
+            return None
+        rows = header['rows']
+        vocabularies = []
+        columns = []
+        for column_header in header['columns']:
+            start = data_start + column_header['offset']
+            end = start + rows * array(column_header['typecode']).itemsize
+            if end > len(cache_view):
+                # A truncated file.
+                return None
+            vocabularies.append(column_header['vocabulary'])
+            columns.append(
+                cache_view[start:end].cast(column_header['typecode'])
+            )
+    except (KeyError, TypeError, ValueError, struct.error):
+        # A damaged header is a cache miss like any other.
+        return None
+    return vocabularies, columns
+
+
+def _share_vocabularies(vocabularies, columns, shared_vocabularies):
+    while len(shared_vocabularies) < len(vocabularies):
+        shared_vocabularies.append(
+            None if vocabularies[len(shared_vocabularies)] is None else []
+        )
+    shared_columns = []
+    for vocabulary, column, shared_vocabulary in zip(
+            vocabularies, columns, shared_vocabularies
+    ):
+        if vocabulary is None:
+            shared_columns.append(column)
+            continue
+        shared_codes = {
+            value: code for code, value in enumerate(shared_vocabulary)
+        }
+        for value in vocabulary:
+            if value not in shared_codes:
+                shared_codes[value] = len(shared_vocabulary)
+                shared_vocabulary.append(value)
+        translation = [shared_codes[value] for value in vocabulary]
+        shared_columns.append(array(
+            get_array_typecode(len(shared_vocabulary)),
+            map(translation.__getitem__, column)
+        ))
+    return shared_vocabularies, shared_columns
+
+
+def load_dataset(file_name, column_count=None, vocabularies=None,
+                 chunk_size=CHUNK_SIZE, numeric_indexes=(), exclude_flag=None):
+    with profiling.phase('read_cache'):
+        dataset = read_dataset_cache(
+            file_name, numeric_indexes=numeric_indexes,
+            exclude_flag=exclude_flag
+        )
+    if dataset is None:
+        with profiling.phase('parse_csv'):
+            dataset = read_encoded_columns(
+                file_name, chunk_size=chunk_size,
+                numeric_indexes=numeric_indexes, exclude_flag=exclude_flag
+            )
+        with profiling.phase('write_cache'):
+            try:
+                write_dataset_cache(
+                    file_name, *dataset, numeric_indexes=numeric_indexes,
+                    exclude_flag=exclude_flag
+                )
+            except OSError:
+                # The cache only saves parsing, e.g. a read-only directory
+                # or a full disk just means parsing again next time.
+                profiling.count('cache_write_errors')
+    dataset_vocabularies, columns = dataset
+    if column_count is not None:
+        dataset_vocabularies = dataset_vocabularies[:column_count]
+        columns = columns[:column_count]
+    if vocabularies is None:
+        return dataset_vocabularies, columns
+    return _share_vocabularies(dataset_vocabularies, columns, vocabularies)
@@ -0,0 +1,683 @@
+import contextlib
+import multiprocessing
+
+from array import array
+from collections import Counter, namedtuple
+from itertools import chain
+from random import Random
+
+from decisiontree import profiling
+from decisiontree.id3_algorithm import (COUNT_MASK,
+                                        calculate_split_information_gain,
+                                        entropy, get_class_increments)
+from decisiontree.inference import SEPARATOR, get_threshold_keys
+from decisiontree.utils import get_array_typecode
+
+PARALLEL_SPLIT_ROWS = 10000
+PARALLEL_SUBTREE_ROWS = 1000
+FIRST_APPEARANCE_CHUNK = 64
+
+
+def encode_column(values):
+    value_codes = {
+        value: code for code, value in enumerate(dict.fromkeys(values))
+    }
+    column = array(
+        get_array_typecode(len(value_codes)),
+        map(value_codes.__getitem__, values)
+    )
+    return list(value_codes), column
+
+
+def encode_columns(file_data, column_count=None, numeric_indexes=()):
+    if column_count is None:
+        column_count = len(file_data[0]) if file_data else 0
+    vocabularies = []
+    columns = []
+    for column_index in range(column_count):
+        values = [line[column_index] for line in file_data]
+        if column_index in numeric_indexes:
+            vocabularies.append(None)
+            columns.append(array('d', map(float, values)))
+            continue
+        vocabulary, column = encode_column(values)
+        vocabularies.append(vocabulary)
+        columns.append(column)
+    return vocabularies, columns
+
+
+def _create_pair_columns(columns, attribute_indexes, decision_column,
+                         class_increments):
+    # Every (attribute, value, class) triple gets one pair code, so a
+    # single Counter pass fills the count tables of all attributes.
+    class_count = len(class_increments)
+    pair_columns = []
+    pair_attributes = []
+    pair_values = []
+    pair_increments = []
+    for attribute_position, attribute_index in enumerate(attribute_indexes):
+        column = columns[attribute_index]
+        offset = len(pair_attributes)
+        vocabulary_size = max(column) + 1 if column else 0
+        pair_attributes.extend(
+            [attribute_position] * vocabulary_size * class_count
+        )
+        pair_values.extend(
+            value for value in range(vocabulary_size)
+            for _ in range(class_count)
+        )
+        pair_increments.extend(class_increments * vocabulary_size)
+        pair_columns.append(array('I', [
+            offset + value * class_count + class_code
+            for value, class_code in zip(column, decision_column)
+        ]))
+    return pair_columns, pair_attributes, pair_values, pair_increments
+
+
+def _count_attribute_samples(context, indexes, categorical_positions=None):
+    # One counting pass for every attribute, keeping each attribute's
+    # values in order of first appearance like _get_attribute_samples_count.
+    if categorical_positions is None:
+        categorical_positions = range(len(context.pair_columns))
+    pair_columns = context.pair_columns
+    pair_attributes = context.pair_attributes
+    pair_values = context.pair_values
+    pair_increments = context.pair_increments
+    attribute_tables = {position: {} for position in categorical_positions}
+    pair_counts = Counter(chain.from_iterable(
+        map(pair_columns[position].__getitem__, indexes)
+        for position in categorical_positions
+    ))
+    for pair, count in pair_counts.items():
+        attribute_table = attribute_tables[pair_attributes[pair]]
+        value = pair_values[pair]
+        attribute_table[value] = (
+            attribute_table.get(value, 0) + count * pair_increments[pair]
+        )
+    return list(attribute_tables.values())
+
+
+def _count_attribute_samples_chunk(task):
+    categorical_positions, indexes = task
+    return _count_attribute_samples(
+        training_context, indexes, categorical_positions
+    )
+
+
+def _find_best_threshold_task(task):
+    numeric_position, sorted_indexes, total_entropy, class_counts = task
+    context = training_context
+    attribute_position = context.numeric_positions[numeric_position]
+    return _find_best_threshold(
+        context,
+        context.columns[context.attribute_indexes[attribute_position]],
+        sorted_indexes, total_entropy, class_counts
+    )
+
+
+def _get_categorical_tasks(context, indexes):
+    categorical_count = len(context.categorical_positions)
+    chunk_size = max(1, -(-categorical_count // context.split_workers))
+    return [
+        (range(chunk, min(chunk + chunk_size, categorical_count)), indexes)
+        for chunk in range(0, categorical_count, chunk_size)
+    ]
+
+
+def _count_node_samples(context, indexes, categorical_positions=None):
+    profiling.count('count_tables')
+    profiling.count('rows_counted', len(indexes))
+    with profiling.phase('count_samples'):
+        if (context.split_pool is None
+                or len(indexes) < context.parallel_split_rows):
+            return _count_attribute_samples(
+                context, indexes, categorical_positions
+            )
+        attribute_tables = []
+        for chunk_tables in context.split_pool.map(
+                _count_attribute_samples_chunk,
+                _get_categorical_tasks(context, indexes)
+        ):
+            attribute_tables.extend(chunk_tables)
+        return attribute_tables
+
+
+def _order_attribute_samples(context, attribute_tables, indexes):
+    # Gains are summed in order of first appearance, which subtraction
+    # loses, so the node rows are scanned in growing chunks only until
+    # every value of the table has been seen again.
+    ordered_tables = []
+    for attribute_position, attribute_table in zip(
+            context.categorical_positions, attribute_tables
+    ):
+        if len(attribute_table) < 2:
+            ordered_tables.append(attribute_table)
+            continue
+        column = context.columns[context.attribute_indexes[attribute_position]]
+        values = {}
+        chunk_start = 0
+        chunk_size = FIRST_APPEARANCE_CHUNK
+        while len(values) < len(attribute_table):
+            values.update(dict.fromkeys(map(
+                column.__getitem__,
+                indexes[chunk_start:chunk_start + chunk_size]
+            )))
+            chunk_start += chunk_size
+            chunk_size *= 2
+        ordered_tables.append(
+            {value: attribute_table[value] for value in values}
+        )
+    return ordered_tables
+
+
+def _subtract_attribute_samples(parent_tables, children_tables):
+    # Histogram subtraction: the rows of one child are the parent rows
+    # minus the rows of all its siblings.
+    attribute_tables = []
+    for position, parent_table in enumerate(parent_tables):
+        attribute_table = {}
+        for value, class_counts in parent_table.items():
+            for child_tables in children_tables:
+                child_counts = child_tables[position].get(value)
+                if child_counts is not None:
+                    class_counts -= child_counts
+            if class_counts:
+                attribute_table[value] = class_counts
+        attribute_tables.append(attribute_table)
+    return attribute_tables
+
+
+def _search_split_in_parallel(context, start, end, indexes, total_entropy,
+                              class_counts, attribute_tables):
+    # Every task carries its node slice because the forked workers only
+    # see the permutations as they were when the pool started.
+    categorical_tasks = []
+    if attribute_tables is None:
+        categorical_tasks = _get_categorical_tasks(context, indexes)
+    numeric_tasks = [
+        (numeric_position, sorted_permutation[start:end], total_entropy,
+         class_counts)
+        for numeric_position, sorted_permutation in enumerate(
+            context.sorted_permutations
+        )
+    ]
+    numeric_results = context.split_pool.map_async(
+        _find_best_threshold_task, numeric_tasks
+    )
+    if attribute_tables is None:
+        attribute_tables = []
+        for chunk_tables in context.split_pool.map(
+                _count_attribute_samples_chunk, categorical_tasks
+        ):
+            attribute_tables.extend(chunk_tables)
+    return attribute_tables, numeric_results.get()
+
+
+def _calculate_information_gain(attribute_tables, total_entropy, total):
+    return [
+        calculate_split_information_gain(
+            total_entropy, attribute_table.values(), total
+        )
+        for attribute_table in attribute_tables
+    ]
+
+
+def _get_attribute_with_max_information_gain(attributes_information_gain):
+    max_information_gain = 0
+    attribute_with_max_information_gain = None
+    for attribute_position, information_gain in enumerate(
+            attributes_information_gain
+    ):
+        if information_gain > max_information_gain:
+            max_information_gain = information_gain
+            attribute_with_max_information_gain = attribute_position
+    return attribute_with_max_information_gain, max_information_gain
+
+
+def _find_best_threshold(context, column, sorted_indexes, total_entropy,
+                         class_counts):
+    # Sweep the node rows in attribute order with cumulative class counts,
+    # scoring a cut after every distinct value.
+    increment_column = context.increment_column
+    total = class_counts & COUNT_MASK
+    max_information_gain = None
+    best_threshold = None
+    best_counts = None
+    left_counts = 0
+    previous_value = column[sorted_indexes[0]]
+    for index in sorted_indexes:
+        value = column[index]
+        if value != previous_value:
+            right_counts = class_counts - left_counts
+            left_total = left_counts & COUNT_MASK
+            right_total = total - left_total
+            information_gain = (
+                total_entropy
+                - (left_total / total) * entropy(left_counts)
+                - (right_total / total) * entropy(right_counts)
+            )
+            if (max_information_gain is None
+                    or information_gain > max_information_gain):
+                max_information_gain = information_gain
+                best_threshold = previous_value
+                best_counts = (left_counts, right_counts)
+            previous_value = value
+        left_counts += increment_column[index]
+    if max_information_gain is None:
+        return 0, None, None
+    return max_information_gain, best_threshold, best_counts
+
+
+TrainingContext = namedtuple('TrainingContext', [
+    'headers', 'vocabularies', 'columns', 'attribute_indexes',
+    'decision_index', 'increment_column', 'categorical_positions',
+    'pair_columns', 'pair_attributes', 'pair_values', 'pair_increments',
+    'numeric_positions',
+    'permutation', 'sorted_permutations', 'max_depth', 'min_samples_split',
+    'min_gain', 'split_workers', 'parallel_split_rows', 'split_pool',
+    'parallel_subtree_rows', 'max_features', 'random',
+])
+
+training_context = None
+
+
+def _partition_node(context, start, end, get_branch):
+    # Group the node slice by branch; the sort is stable so every branch
+    # keeps the reversed row order train_decision_tree used to produce,
+    # and every presorted numeric slice keeps its attribute order.
+    permutation = context.permutation
+    with profiling.phase('partition'):
+        permutation[start:end] = array('I', sorted(
+            reversed(permutation[start:end]), key=get_branch
+        ))
+        for sorted_permutation in context.sorted_permutations:
+            sorted_permutation[start:end] = array('I', sorted(
+                sorted_permutation[start:end], key=get_branch
+            ))
+
+
+def _get_majority_label(context, indexes):
+    decision_index = context.decision_index
+    decision_counts = Counter(
+        map(context.columns[decision_index].__getitem__, indexes)
+    )
+    decision_code = decision_counts.most_common(1)[0][0]
+    return context.vocabularies[decision_index][decision_code]
+
+
+def _sample_candidates(context):
+    # Random forests look at max_features attributes drawn anew at every
+    # node; returns the categorical and numeric positions among them.
+    if context.max_features is None:
+        return (range(len(context.categorical_positions)),
+                range(len(context.numeric_positions)))
+    candidates = set(context.random.sample(
+        range(len(context.attribute_indexes)),
+        min(context.max_features, len(context.attribute_indexes))
+    ))
+    return [
+        categorical_position for categorical_position, attribute_position
+        in enumerate(context.categorical_positions)
+        if attribute_position in candidates
+    ], [
+        numeric_position for numeric_position, attribute_position
+        in enumerate(context.numeric_positions)
+        if attribute_position in candidates
+    ]
+
+
+def _needs_attribute_samples(context, branch, depth):
+    _, start, end, class_counts = branch
+    return ((context.max_depth is None or depth < context.max_depth)
+            and end - start >= context.min_samples_split
+            and entropy(class_counts) > 0)
+
+
+def _get_children_samples(context, attribute_tables, branches, depth):
+    # Count only the smaller children and derive the largest one from the
+    # parent tables; children that will be leaves get no tables at all.
+    # Nodes that sample their attributes only count the sampled ones, so
+    # their children count their own.
+    children_tables = [None] * len(branches)
+    needed = [
+        _needs_attribute_samples(context, branch, depth)
+        for branch in branches
+    ]
+    if (context.max_features is not None
+            or not context.categorical_positions or not any(needed)):
+        return children_tables
+    largest = max(
+        range(len(branches)),
+        key=lambda branch: branches[branch][2] - branches[branch][1]
+    )
+    for branch, (_, start, end, _) in enumerate(branches):
+        if branch != largest and (needed[branch] or needed[largest]):
+            children_tables[branch] = _count_node_samples(
+                context, context.permutation[start:end]
+            )
+    if needed[largest]:
+        _, start, end, _ = branches[largest]
+        profiling.count('count_tables_subtracted')
+        with profiling.phase('subtract_samples'):
+            children_tables[largest] = _order_attribute_samples(
+                context, _subtract_attribute_samples(attribute_tables, [
+                    child_tables for branch, child_tables in enumerate(
+                        children_tables
+                    ) if branch != largest
+                ]), context.permutation[start:end]
+            )
+    return [
+        child_tables if is_needed else None
+        for child_tables, is_needed in zip(children_tables, needed)
+    ]
+
+
+def _split_node(context, start, end, class_counts, depth,
+                attribute_tables=None):
+    # Returns a leaf label, or the node dict with its keys in place plus
+    # the (key, start, end, class_counts, attribute_tables) slice of every
+    # branch.
+    headers = context.headers
+    columns = context.columns
+    indexes = context.permutation[start:end]
+    total = end - start
+    profiling.count('nodes_built')
+    profiling.count('rows_scanned', total)
+    if ((context.max_depth is not None and depth >= context.max_depth)
+            or total < context.min_samples_split):
+        return _get_majority_label(context, indexes), []
+    total_entropy = entropy(class_counts)
+    if not total_entropy:
+        # A pure node has no positive gain and keeps its first row label.
+        decision_index = context.decision_index
+        decision_code = columns[decision_index][indexes[0]]
+        return context.vocabularies[decision_index][decision_code], []
+
+    attributes_information_gain = [0] * len(context.attribute_indexes)
+    categorical_candidates, numeric_candidates = _sample_candidates(context)
+    if (context.split_pool is not None
+            and total >= context.parallel_split_rows):
+        attribute_tables, numeric_results = _search_split_in_parallel(
+            context, start, end, indexes, total_entropy, class_counts,
+            attribute_tables
+        )
+    else:
+        if attribute_tables is None:
+            attribute_tables = _count_node_samples(
+                context, indexes, categorical_candidates
+            )
+        with profiling.phase('find_thresholds'):
+            numeric_results = [
+                _find_best_threshold(
+                    context,
+                    columns[context.attribute_indexes[
+                        context.numeric_positions[numeric_position]
+                    ]],
+                    context.sorted_permutations[numeric_position][start:end],
+                    total_entropy, class_counts
+                )
+                for numeric_position in numeric_candidates
+            ]
+    categorical_information_gain = _calculate_information_gain(
+        attribute_tables, total_entropy, total
+    )
+    for categorical_position, information_gain in zip(
+            categorical_candidates, categorical_information_gain
+    ):
+        attributes_information_gain[
+            context.categorical_positions[categorical_position]
+        ] = information_gain
+    thresholds = {}
+    for numeric_position, numeric_result in zip(
+            numeric_candidates, numeric_results
+    ):
+        attribute_position = context.numeric_positions[numeric_position]
+        information_gain, threshold, counts = numeric_result
+        attributes_information_gain[attribute_position] = information_gain
+        thresholds[attribute_position] = (threshold, counts)
+
+    selected_position, max_information_gain = (
+        _get_attribute_with_max_information_gain(attributes_information_gain)
+    )
+    if selected_position is None:
+        decision_index = context.decision_index
+        decision_code = columns[decision_index][indexes[0]]
+        return context.vocabularies[decision_index][decision_code], []
+    if max_information_gain <= context.min_gain:
+        return _get_majority_label(context, indexes), []
+
+    attribute_index = context.attribute_indexes[selected_position]
+    attribute_column = columns[attribute_index]
+    id3_tree = {}
+    if selected_position in thresholds:
+        threshold, counts = thresholds[selected_position]
+        _partition_node(
+            context, start, end,
+            lambda index: attribute_column[index] > threshold
+        )
+        middle = start + (counts[0] & COUNT_MASK)
+        less_equal_key, greater_key = get_threshold_keys(
+            headers[attribute_index], threshold
+        )
+        id3_tree[less_equal_key] = None
+        id3_tree[greater_key] = None
+        branches = [
+            (less_equal_key, start, middle, counts[0]),
+            (greater_key, middle, end, counts[1]),
+        ]
+        return id3_tree, _add_children_samples(
+            context, attribute_tables, branches, depth
+        )
+
+    attribute_vocabulary = context.vocabularies[attribute_index]
+    attribute_table = attribute_tables[categorical_candidates.index(
+        context.categorical_positions.index(selected_position)
+    )]
+    _partition_node(context, start, end, attribute_column.__getitem__)
+    variations_slices = {}
+    variation_start = start
+    for value in sorted(attribute_table):
+        variation_end = variation_start + (
+            attribute_table[value] & COUNT_MASK
+        )
+        variations_slices[value] = (variation_start, variation_end)
+        variation_start = variation_end
+
+    variation_codes = {
+        attribute_vocabulary[value]: value for value in attribute_table
+    }
+    branches = []
+    for variation in set(list(variation_codes)):
+        value = variation_codes[variation]
+        tree_key = headers[attribute_index] + SEPARATOR + variation
+        id3_tree[tree_key] = None
+        branches.append(
+            (tree_key,) + variations_slices[value]
+            + (attribute_table[value],)
+        )
+    return id3_tree, _add_children_samples(
+        context, attribute_tables, branches, depth
+    )
+
+
+def _add_children_samples(context, attribute_tables, branches, depth):
+    return [
+        branch + (child_tables,) for branch, child_tables in zip(
+            branches, _get_children_samples(
+                context, attribute_tables, branches, depth + 1
+            )
+        )
+    ]
+
+
+def _build_tree(context, start, end, class_counts, depth=0,
+                attribute_tables=None):
+    # Explicit work stack instead of one Python frame per tree level.
+    root = {}
+    work = [(root, None, start, end, class_counts, attribute_tables, depth)]
+    while work:
+        (parent, tree_key, start, end, class_counts, attribute_tables,
+         depth) = work.pop()
+        node, branches = _split_node(
+            context, start, end, class_counts, depth, attribute_tables
+        )
+        parent[tree_key] = node
+        for branch in reversed(branches):
+            work.append((node,) + branch + (depth + 1,))
+    return root[None]
+
+
+def _build_subtree_task(task):
+    # The forked worker only knows the permutations from before the pool
+    # started, so the task brings the current order of its own slice.
+    task_id, start, end, class_counts, attribute_tables, depth, slices = task
+    context = training_context
+    context.permutation[start:end] = slices[0]
+    for sorted_permutation, sorted_slice in zip(
+            context.sorted_permutations, slices[1:]
+    ):
+        sorted_permutation[start:end] = sorted_slice
+    return task_id, _build_tree(
+        context, start, end, class_counts, depth, attribute_tables
+    )
+
+
+def _build_tree_in_parallel(context, subtree_pool, subtree_workers, start,
+                            end, class_counts):
+    # Nodes too large to be a single task are split here, subtrees of at
+    # least parallel_subtree_rows rows go to the pool largest first and the
+    # small ones are built in this process while the workers run.
+    largest_task = max(
+        context.parallel_subtree_rows, (end - start) // subtree_workers
+    )
+    root = {}
+    work = [(root, None, start, end, class_counts, None, 0)]
+    subtree_tasks = []
+    subtree_targets = []
+    inline_subtrees = []
+    while work:
+        (parent, tree_key, start, end, class_counts, attribute_tables,
+         depth) = work.pop()
+        if end - start < context.parallel_subtree_rows:
+            inline_subtrees.append((
+                parent, tree_key, start, end, class_counts, depth,
+                attribute_tables
+            ))
+            continue
+        if depth > 0 and end - start <= largest_task:
+            slices = [context.permutation[start:end]] + [
+                sorted_permutation[start:end]
+                for sorted_permutation in context.sorted_permutations
+            ]
+            subtree_tasks.append((
+                len(subtree_targets), start, end, class_counts,
+                attribute_tables, depth, slices
+            ))
+            subtree_targets.append((parent, tree_key))
+            continue
+        node, branches = _split_node(
+            context, start, end, class_counts, depth, attribute_tables
+        )
+        parent[tree_key] = node
+        for branch in reversed(branches):
+            work.append((node,) + branch + (depth + 1,))
+
+    subtree_tasks.sort(key=lambda task: task[2] - task[1], reverse=True)
+    subtree_results = subtree_pool.imap_unordered(
+        _build_subtree_task, subtree_tasks
+    )
+    for inline_subtree in inline_subtrees:
+        parent, tree_key = inline_subtree[:2]
+        parent[tree_key] = _build_tree(context, *inline_subtree[2:])
+    for task_id, subtree in subtree_results:
+        parent, tree_key = subtree_targets[task_id]
+        parent[tree_key] = subtree
+    return root[None]
+
+
+def train_columnar_tree(headers, vocabularies, columns, decision_index,
+                        indexes=None, max_depth=None,
+                        min_samples_split=2, min_gain=0, split_workers=1,
+                        parallel_split_rows=PARALLEL_SPLIT_ROWS,
+                        subtree_workers=1,
+                        parallel_subtree_rows=PARALLEL_SUBTREE_ROWS,
+                        max_features=None, seed=None):
+    # Columns without a vocabulary hold numbers and are split on the best
+    # threshold at every node instead of once per value. Nodes deeper than
+    # max_depth, with fewer than min_samples_split rows or whose best gain
+    # is not above min_gain become majority leaves. With split_workers > 1
+    # nodes of at least parallel_split_rows rows score their attributes on
+    # a process pool, and with subtree_workers > 1 independent subtrees are
+    # trained on another one. Every column but decision_index is an
+    # attribute, and the decision may have any number of classes. indexes
+    # may repeat rows, as bootstrap samples do. With max_features every
+    # node only considers that many attributes, drawn with a Random seeded
+    # by seed; such trees are built in this process only.
+    global training_context
+    decision_column = columns[decision_index]
+    if indexes is None:
+        indexes = range(len(decision_column))
+    permutation = array('I', indexes)
+    class_increments = get_class_increments(len(vocabularies[decision_index]))
+    # The class counts of one row, so cumulative counts are a running sum.
+    increment_column = list(map(class_increments.__getitem__, decision_column))
+    attribute_indexes = [
+        column_index for column_index in range(len(columns))
+        if column_index != decision_index
+    ]
+    categorical_positions = []
+    numeric_positions = []
+    for attribute_position, attribute_index in enumerate(attribute_indexes):
+        if vocabularies[attribute_index] is None:
+            numeric_positions.append(attribute_position)
+        else:
+            categorical_positions.append(attribute_position)
+    with profiling.phase('presort'):
+        (pair_columns, pair_attributes, pair_values,
+         pair_increments) = _create_pair_columns(
+            columns,
+            [attribute_indexes[position]
+             for position in categorical_positions],
+            decision_column, class_increments
+        )
+        sorted_permutations = [
+            array('I', sorted(
+                permutation,
+                key=columns[attribute_indexes[position]].__getitem__
+            ))
+            for position in numeric_positions
+        ]
+    context = TrainingContext(
+        headers, vocabularies, columns, attribute_indexes, decision_index,
+        increment_column, categorical_positions, pair_columns,
+        pair_attributes, pair_values, pair_increments, numeric_positions,
+        permutation,
+        sorted_permutations, max_depth, min_samples_split, min_gain,
+        split_workers, parallel_split_rows, None, parallel_subtree_rows,
+        max_features, Random(seed)
+    )
+    class_counts = sum(map(increment_column.__getitem__, permutation))
+    if max_features is not None or (
+            split_workers <= 1 and subtree_workers <= 1
+    ):
+        return _build_tree(context, 0, len(permutation), class_counts)
+    training_context = context
+    process_context = multiprocessing.get_context('fork')
+    try:
+        with contextlib.ExitStack() as pools:
+            if split_workers > 1:
+                context = context._replace(split_pool=pools.enter_context(
+                    process_context.Pool(split_workers)
+                ))
+            if subtree_workers <= 1:
+                return _build_tree(context, 0, len(permutation), class_counts)
+            subtree_pool = pools.enter_context(
+                process_context.Pool(subtree_workers)
+            )
+            return _build_tree_in_parallel(
+                context, subtree_pool, subtree_workers, 0, len(permutation),
+                class_counts
+            )
+    finally:
+        # The workers are gone, so the columns need not outlive training.
+        training_context = None
@@ -0,0 +1,174 @@
+import math
+import multiprocessing
+
+from array import array
+from random import Random
+
+from decisiontree import profiling
+from decisiontree.columnar import train_columnar_tree
+from decisiontree.inference import (compile_tree, create_score,
+                                    predict_encoded_batch)
+
+FOREST_SIZE = 100
+SEED_BITS = 63
+
+forest_data = None
+
+
+def get_max_features(attributes_count):
+    return max(1, int(math.sqrt(attributes_count)))
+
+
+def draw_bootstrap(indexes, random):
+    # len(indexes) draws with replacement, kept as a count per row: the
+    # sample repeats every drawn row count times, in the order of indexes,
+    # and the rows never drawn are out of bag.
+    counts = array('I', [0]) * len(indexes)
+    for position in random.choices(range(len(indexes)), k=len(indexes)):
+        counts[position] += 1
+    sample = array('I')
+    out_of_bag = array('I')
+    for index, count in zip(indexes, counts):
+        if count:
+            sample.extend([index] * count)
+        else:
+            out_of_bag.append(index)
+    return sample, out_of_bag
+
+
+def _add_votes(votes, label, positions, positions_count):
+    label_votes = votes.get(label)
+    if label_votes is None:
+        label_votes = votes[label] = array('I', [0]) * positions_count
+    for position in positions:
+        label_votes[position] += 1
+
+
+def _get_majority_votes(votes, positions_count):
+    # Ties go to the label that got its first vote first.
+    predictions = [None] * positions_count
+    max_votes = array('I', [0]) * positions_count
+    for label, label_votes in votes.items():
+        for position, label_count in enumerate(label_votes):
+            if label_count > max_votes[position]:
+                max_votes[position] = label_count
+                predictions[position] = label
+    return predictions
+
+
+def _train_forest_tree(tree_seed):
+    (headers, vocabularies, columns, decision_index, indexes, max_features,
+     max_depth, min_samples_split, min_gain) = forest_data
+    random = Random(tree_seed)
+    sample, out_of_bag = draw_bootstrap(indexes, random)
+    id3_tree = train_columnar_tree(
+        headers, vocabularies, columns, decision_index, sample, max_depth,
+        min_samples_split, min_gain, max_features=max_features,
+        seed=random.getrandbits(SEED_BITS)
+    )
+    out_of_bag_predictions = predict_encoded_batch(
+        compile_tree(id3_tree, headers, vocabularies), columns, out_of_bag
+    )
+    return id3_tree, out_of_bag, out_of_bag_predictions
+
+
+def _collect_out_of_bag_votes(results, votes, rows_count):
+    for id3_tree, out_of_bag, out_of_bag_predictions in results:
+        labels = {}
+        for index, label in zip(out_of_bag, out_of_bag_predictions):
+            if label is not None:
+                labels.setdefault(label, []).append(index)
+        for label, label_indexes in labels.items():
+            _add_votes(votes, label, label_indexes, rows_count)
+        yield id3_tree
+
+
+def train_forest(headers, vocabularies, columns, decision_index,
+                 indexes=None, trees_count=FOREST_SIZE, max_features=None,
+                 seed=None, workers=1, max_depth=None, min_samples_split=2,
+                 min_gain=0):
+    # Every tree trains on a bootstrap sample of indexes over the same
+    # encoded columns, looking at max_features random attributes per node
+    # (the square root of the attribute count by default). Trees only
+    # depend on their own seed, so the forest is the same for any number
+    # of workers. Returns the trees and their out-of-bag accuracy: every
+    # row is voted on by the trees that did not see it.
+    global forest_data
+    decision_column = columns[decision_index]
+    if indexes is None:
+        indexes = range(len(decision_column))
+    if max_features is None:
+        max_features = get_max_features(len(columns) - 1)
+    random = Random(seed)
+    tree_seeds = [random.getrandbits(SEED_BITS) for _ in range(trees_count)]
+    # Workers are forked after forest_data is set, so they read the encoded
+    # columns from the parent's pages instead of pickled copies.
+    forest_data = (
+        headers, vocabularies, columns, decision_index, indexes,
+        max_features, max_depth, min_samples_split, min_gain
+    )
+    rows_count = len(decision_column)
+    votes = {}
+    forest = []
+    with profiling.phase('train_forest'):
+        if workers <= 1:
+            results = map(_train_forest_tree, tree_seeds)
+            forest.extend(_collect_out_of_bag_votes(
+                results, votes, rows_count
+            ))
+        else:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(min(workers, trees_count)) as pool:
+                forest.extend(_collect_out_of_bag_votes(
+                    pool.imap(_train_forest_tree, tree_seeds), votes,
+                    rows_count
+                ))
+    profiling.count('forest_trees', len(forest))
+    predictions = _get_majority_votes(votes, rows_count)
+    decision_vocabulary = vocabularies[decision_index]
+    voted_indexes = [
+        index for index in indexes if predictions[index] is not None
+    ]
+    _, _, out_of_bag_accuracy = create_score(
+        [predictions[index] for index in voted_indexes],
+        [decision_vocabulary[decision_column[index]]
+         for index in voted_indexes]
+    )
+    return forest, out_of_bag_accuracy
+
+
+def compile_forest(forest, headers, vocabularies=None):
+    return [compile_tree(id3_tree, headers, vocabularies)
+            for id3_tree in forest]
+
+
+def predict_forest_encoded_batch(compiled_forest, columns, indexes):
+    # Every tree predicts the whole batch and gives each row one vote for
+    # its label.
+    positions_count = len(indexes)
+    votes = {}
+    for compiled_tree in compiled_forest:
+        labels = {}
+        for position, label in enumerate(predict_encoded_batch(
+                compiled_tree, columns, indexes
+        )):
+            if label is not None:
+                labels.setdefault(label, []).append(position)
+        for label, positions in labels.items():
+            _add_votes(votes, label, positions, positions_count)
+    return _get_majority_votes(votes, positions_count)
+
+
+def score_forest_encoded(compiled_forest, vocabularies, columns,
+                         decision_index, indexes):
+    profiling.count('accuracy_evaluations')
+    profiling.count('rows_scored', len(indexes))
+    with profiling.phase('score_forest'):
+        predictions = predict_forest_encoded_batch(
+            compiled_forest, columns, indexes
+        )
+    decision_column = columns[decision_index]
+    decision_vocabulary = vocabularies[decision_index]
+    return create_score(predictions, [
+        decision_vocabulary[decision_column[index]] for index in indexes
+    ])
@@ -1,18 +1,65 @@
 import math
 
-POSITIVE_INDEX = 'positive'
-NEGATIVE_INDEX = 'negative'
+from functools import lru_cache
 
+from decisiontree import profiling
 
-def entropy(total, positive, negative):
+ENTROPY_CACHE_SIZE = 1 << 16
+COUNT_BITS = 32
+COUNT_MASK = (1 << COUNT_BITS) - 1
+
+
+# The class counts of a row of a count table are packed in one int of
+# COUNT_BITS wide lanes, the row total first and then every class code, so
+# a table holds one int per attribute value and adding or subtracting rows
+# adds or subtracts every class at once.
+def get_class_increments(class_count):
+    return [
+        1 + (1 << (COUNT_BITS * (class_code + 1)))
+        for class_code in range(class_count)
+    ]
+
+
+def pack_class_counts(class_counts):
+    packed = sum(class_counts)
+    for class_code, class_count in enumerate(class_counts):
+        packed += class_count << (COUNT_BITS * (class_code + 1))
+    return packed
+
+
+# The same count rows come back across attributes, nodes and cut points.
+# The formula is kept as is, since any other rounding would break ties
+# between attributes differently.
+@lru_cache(maxsize=ENTROPY_CACHE_SIZE)
+def entropy(class_counts):
+    total = class_counts & COUNT_MASK
     value = 0
-    if positive:
-        value -= (positive / total * math.log(positive / total, 2))
-    if negative:
-        value -= (negative / total * math.log(negative / total, 2))
+    class_counts >>= COUNT_BITS
+    while class_counts:
+        class_count = class_counts & COUNT_MASK
+        if class_count:
+            value -= (class_count / total * math.log(class_count / total, 2))
+        class_counts >>= COUNT_BITS
     return value
 
 
+def calculate_split_information_gain(total_entropy, count_rows, total):
+    value = total_entropy
+    for class_counts in count_rows:
+        value -= ((class_counts & COUNT_MASK) / total) * entropy(
+            class_counts
+        )
+    return value
+
+
+def get_label_codes(file_data, decision_index):
+    return {
+        label: code for code, label in enumerate(dict.fromkeys(
+            line[decision_index] for line in file_data
+        ))
+    }
+
+
 def _init_attributes_information_gain_dict(attributes):
     attributes_information_gain_dict = {}
     for attribute in attributes:
@@ -21,65 +68,51 @@ def _init_attributes_information_gain_dict(attributes):
 
 
 def calculate_information_gain(
-        attributes, total_entropy, file_data,
-        positive_flag, decision_index
+        attributes, total_entropy, file_data, decision_index
 ):
-    attribute_index = 0
-    attributes_information_gain_dict = _init_attributes_information_gain_dict(attributes)
+    # attributes names the columns in order; the one at decision_index, if
+    # named at all, is the label and gets no gain.
+    attributes_information_gain_dict = _init_attributes_information_gain_dict(
+        attribute for attribute_index, attribute in enumerate(attributes)
+        if attribute_index != decision_index
+    )
     total = len(file_data)
-    while attribute_index < decision_index:
-        attribute_data = _get_attribute_samples_count(
-            attribute_index, file_data, positive_flag, decision_index
-        )
-        value = total_entropy
-        positives_count, negatives_count = 0, 0
-        for attribute in attribute_data:
-            negative = attribute_data[attribute][NEGATIVE_INDEX]
-            negatives_count += negative
-            positive = attribute_data[attribute][POSITIVE_INDEX]
-            positives_count += positive
-            attribute_total = positive + negative
-            value -= (attribute_total/total) * entropy(
-                attribute_total, positive, negative
+    label_codes = get_label_codes(file_data, decision_index)
+    class_increments = get_class_increments(len(label_codes))
+    label_increments = {
+        label: class_increments[code] for label, code in label_codes.items()
+    }
+    for attribute_index, attribute in enumerate(attributes):
+        if attribute_index == decision_index:
+            continue
+        with profiling.phase('count_samples'):
+            attribute_data = _get_attribute_samples_count(
+                attribute_index, file_data, label_increments, decision_index
+            )
+        profiling.count('count_tables')
+        profiling.count('rows_counted', len(file_data))
+        attributes_information_gain_dict[attribute] = (
+            calculate_split_information_gain(
+                total_entropy, attribute_data.values(), total
             )
-        attributes_information_gain_dict[attributes[attribute_index]] = value
-        attribute_index += 1
+        )
     return attributes_information_gain_dict
 
 
-def calculate_total_entropy(file_data, positive_flag, negative_flag, decision_index):
-    decision_index_attribute = _get_attribute_samples_count(
-        decision_index, file_data, positive_flag, decision_index
-    )
-    positive = decision_index_attribute[
-        positive_flag
-    ][POSITIVE_INDEX] if decision_index_attribute.get(positive_flag) is not None else 0  # noqa
-    negative = decision_index_attribute[
-        negative_flag
-    ][NEGATIVE_INDEX] if decision_index_attribute.get(negative_flag) is not None else 0  # noqa
-    total_entropy = entropy(
-        len(file_data),
-        positive,
-        negative
-    )
-    return total_entropy
+def calculate_total_entropy(file_data, decision_index):
+    label_codes = get_label_codes(file_data, decision_index)
+    class_counts = [0] * len(label_codes)
+    for line in file_data:
+        class_counts[label_codes[line[decision_index]]] += 1
+    return entropy(pack_class_counts(class_counts))
 
 
 def _get_attribute_samples_count(
-        attribute_index, file_data, positive_flag, decision_index
+        attribute_index, file_data, label_increments, decision_index
 ):
-    initial_value = {
-        POSITIVE_INDEX: 0,
-        NEGATIVE_INDEX: 0,
-    }
-    attribute_values = [value[attribute_index] for value in file_data]
     attribute_data = {}
-    for attribute in attribute_values:
-        attribute_data[attribute] = initial_value.copy()
-
     for line in file_data:
-        if line[decision_index] == positive_flag:
-            attribute_data[line[attribute_index]][POSITIVE_INDEX] += 1
-        else:
-            attribute_data[line[attribute_index]][NEGATIVE_INDEX] += 1
-    return attribute_data
\ No newline at end of file
+        attribute_data[line[attribute_index]] = attribute_data.get(
+            line[attribute_index], 0
+        ) + label_increments[line[decision_index]]
+    return attribute_data
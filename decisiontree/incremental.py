@@ -0,0 +1,277 @@
+import pickle
+
+from array import array
+from collections import Counter, namedtuple
+
+from decisiontree import profiling
+from decisiontree.id3_algorithm import COUNT_MASK
+from decisiontree.inference import SEPARATOR, get_threshold_keys
+from decisiontree.streaming import (StreamingContext, add_label_increments,
+                                    get_majority_label, is_open_node,
+                                    select_split)
+from decisiontree.utils import replace_file
+
+CHECKPOINT_VERSION = 2
+CODE_TYPECODE = 'I'
+NUMERIC_TYPECODE = 'd'
+ROW_TYPECODE = 'I'
+
+# Every row absorbed so far is kept once in columns, encoded through
+# context.vocabularies and value_codes, and nodes refer to rows by index.
+IncrementalTree = namedtuple(
+    'IncrementalTree', ['context', 'root', 'value_codes', 'columns']
+)
+
+
+class _IncrementalNode:
+    # Every node keeps the count tables of the rows that reached it, one
+    # dict per attribute of value -> packed class counts, so its best split
+    # can be checked again after every batch. Leaves also keep the indexes
+    # of their rows, which is what a subtree is rebuilt from when its split
+    # changes.
+    __slots__ = ['class_counts', 'attribute_tables', 'attribute_position',
+                 'threshold', 'children', 'rows']
+
+    def __init__(self, attributes_count):
+        self.class_counts = 0
+        self.attribute_tables = [{} for _ in range(attributes_count)]
+        self.attribute_position = None
+        self.threshold = None
+        self.children = None
+        self.rows = array(ROW_TYPECODE)
+
+
+def create_incremental_tree(headers, decision_index, attribute_indexes,
+                            numeric_indexes=(), max_depth=None,
+                            min_samples_split=2, min_gain=0):
+    # The label column needs no header when it is the last one.
+    vocabularies = [
+        None if column_index in numeric_indexes else []
+        for column_index in range(max(len(headers), decision_index + 1))
+    ]
+    context = StreamingContext(
+        headers, decision_index, attribute_indexes, numeric_indexes,
+        vocabularies, max_depth, min_samples_split, min_gain, {}, []
+    )
+    return IncrementalTree(
+        context, _IncrementalNode(len(attribute_indexes)), [
+            None if vocabulary is None else {} for vocabulary in vocabularies
+        ], [
+            array(NUMERIC_TYPECODE if vocabulary is None else CODE_TYPECODE)
+            for vocabulary in vocabularies
+        ]
+    )
+
+
+def _append_rows(incremental_tree, rows):
+    # Categorical values get codes in order of first appearance, like the
+    # values of the in-memory trainers.
+    context = incremental_tree.context
+    for column, values, vocabulary, codes in zip(
+            incremental_tree.columns, zip(*rows), context.vocabularies,
+            incremental_tree.value_codes
+    ):
+        if codes is None:
+            column.extend(map(float, values))
+            continue
+        for value in dict.fromkeys(values):
+            if value not in codes:
+                codes[value] = len(vocabulary)
+                vocabulary.append(value)
+        column.extend(map(codes.__getitem__, values))
+
+
+def _count_rows(context, node, columns, rows):
+    label_increments = context.label_increments
+    decision_column = columns[context.decision_index]
+    labels = [decision_column[row] for row in rows]
+    node.class_counts += sum(map(label_increments.__getitem__, labels))
+    for attribute_table, attribute_index in zip(
+            node.attribute_tables, context.attribute_indexes
+    ):
+        for (value, label), count in Counter(zip(
+                map(columns[attribute_index].__getitem__, rows), labels
+        )).items():
+            attribute_table[value] = (
+                attribute_table.get(value, 0)
+                + count * label_increments[label]
+            )
+
+
+def _get_branch(node, value):
+    if node.threshold is None:
+        return value
+    return value > node.threshold
+
+
+def _group_rows(context, node, columns, rows):
+    column = columns[context.attribute_indexes[node.attribute_position]]
+    groups = {}
+    for row in rows:
+        groups.setdefault(
+            _get_branch(node, column[row]), array(ROW_TYPECODE)
+        ).append(row)
+    return groups
+
+
+def _collect_rows(node):
+    rows = array(ROW_TYPECODE)
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node.children is None:
+            rows.extend(node.rows)
+        else:
+            nodes.extend(node.children.values())
+    return rows
+
+
+def _build_subtree(context, columns, node, depth):
+    # Batch ID3 from the rows of node, whose tables already count them.
+    nodes = [(node, depth)]
+    while nodes:
+        node, depth = nodes.pop()
+        profiling.count('nodes_built')
+        selected = None
+        if is_open_node(context, node.class_counts, depth):
+            selected = select_split(
+                context, node.attribute_tables, node.class_counts
+            )
+        if selected is None:
+            continue
+        node.attribute_position, node.threshold, _ = selected
+        node.children = {}
+        for branch, branch_rows in _group_rows(
+                context, node, columns, node.rows
+        ).items():
+            child = _IncrementalNode(len(context.attribute_indexes))
+            _count_rows(context, child, columns, branch_rows)
+            child.rows = branch_rows
+            node.children[branch] = child
+            nodes.append((child, depth + 1))
+        node.rows = None
+
+
+def _rebuild_subtree(context, columns, node, rows, depth):
+    # rows are counted in the tables of node but not yet in its leaves.
+    profiling.count('subtrees_rebuilt')
+    node.rows = _collect_rows(node)
+    node.rows.extend(rows)
+    node.attribute_position = None
+    node.threshold = None
+    node.children = None
+    _build_subtree(context, columns, node, depth)
+
+
+def update_incremental_tree(incremental_tree, rows):
+    # Adds a batch of rows: they are routed down the tree updating the
+    # tables of the nodes they reach, and only a reached node whose best
+    # split is no longer its split gets its subtree rebuilt, so a batch
+    # costs its own rows times the tree depth unless the tree changes.
+    if not rows:
+        return incremental_tree
+    context = incremental_tree.context
+    columns = incremental_tree.columns
+    start = len(columns[context.decision_index])
+    _append_rows(incremental_tree, rows)
+    add_label_increments(
+        context.label_increments, columns[context.decision_index][start:],
+        context.class_labels
+    )
+    profiling.count('rows_absorbed', len(rows))
+    nodes = [(
+        incremental_tree.root,
+        array(ROW_TYPECODE, range(start, start + len(rows))), 0
+    )]
+    while nodes:
+        node, node_rows, depth = nodes.pop()
+        _count_rows(context, node, columns, node_rows)
+        selected = None
+        if is_open_node(context, node.class_counts, depth):
+            selected = select_split(
+                context, node.attribute_tables, node.class_counts
+            )
+        if node.children is None:
+            node.rows.extend(node_rows)
+            if selected is not None:
+                _build_subtree(context, columns, node, depth)
+            continue
+        if (selected is None
+                or selected[:2] != (node.attribute_position, node.threshold)):
+            _rebuild_subtree(context, columns, node, node_rows, depth)
+            continue
+        for branch, branch_rows in _group_rows(
+                context, node, columns, node_rows
+        ).items():
+            child = node.children.get(branch)
+            if child is None:
+                # A value the split had not seen gets a branch of its own.
+                child = node.children[branch] = _IncrementalNode(
+                    len(context.attribute_indexes)
+                )
+            nodes.append((child, branch_rows, depth + 1))
+    return incremental_tree
+
+
+def convert_incremental_to_id3(incremental_tree):
+    context = incremental_tree.context
+    root = incremental_tree.root
+    if not root.class_counts & COUNT_MASK:
+        return None
+    headers = context.headers
+    parent = {}
+    nodes = [(root, parent, None)]
+    while nodes:
+        node, parent_subtree, tree_key = nodes.pop()
+        if node.children is None:
+            parent_subtree[tree_key] = get_majority_label(
+                context, node.class_counts
+            )
+            continue
+        attribute_index = context.attribute_indexes[node.attribute_position]
+        header = headers[attribute_index]
+        id3_tree = parent_subtree[tree_key] = {}
+        if node.threshold is None:
+            vocabulary = context.vocabularies[attribute_index]
+            branches = [
+                (header + SEPARATOR + vocabulary[branch], child)
+                for branch, child in node.children.items()
+            ]
+        else:
+            branches = [
+                (branch_key, node.children[branch])
+                for branch_key, branch in zip(
+                    get_threshold_keys(header, node.threshold),
+                    [False, True]
+                ) if branch in node.children
+            ]
+        for child_key, child in branches:
+            id3_tree[child_key] = None
+        for child_key, child in reversed(branches):
+            nodes.append((child, id3_tree, child_key))
+    return parent[None]
+
+
+def write_incremental_checkpoint(incremental_tree, file_name):
+    with replace_file(file_name) as checkpoint_file:
+        pickle.dump(
+            (CHECKPOINT_VERSION, incremental_tree), checkpoint_file,
+            pickle.HIGHEST_PROTOCOL
+        )
+
+
+def read_incremental_checkpoint(file_name):
+    # Returns None when there is no checkpoint yet. Loading a pickle can
+    # run arbitrary code, so only checkpoints written by
+    # write_incremental_checkpoint from a trusted source may be read.
+    try:
+        with open(file_name, 'rb') as checkpoint_file:
+            version, incremental_tree = pickle.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    if version != CHECKPOINT_VERSION:
+        # Unlike a cache it cannot be rebuilt, so it is never dropped.
+        raise ValueError('Unsupported checkpoint version {} in {}'.format(
+            version, file_name
+        ))
+    return incremental_tree
@@ -0,0 +1,267 @@
+from array import array
+from collections import namedtuple
+
+from decisiontree import profiling
+
+SEPARATOR = '__'
+LEAF = -1
+
+LESS_EQUAL = '<='
+GREATER = '>'
+
+CompiledTree = namedtuple('CompiledTree', [
+    'attributes', 'features', 'children', 'leaves', 'labels', 'thresholds'
+])
+
+
+def format_threshold(threshold):
+    if threshold.is_integer():
+        return str(int(threshold))
+    return repr(threshold)
+
+
+def get_threshold_keys(attribute, threshold):
+    threshold_key = SEPARATOR + format_threshold(threshold)
+    return (attribute + SEPARATOR + LESS_EQUAL + threshold_key,
+            attribute + SEPARATOR + GREATER + threshold_key)
+
+
+def compile_tree(id3_tree, headers, vocabularies=None):
+    # Numeric nodes, keyed as attribute__<=__threshold and
+    # attribute__>__threshold, keep their threshold and a two-slot child
+    # table indexed by value > threshold.
+    features = array('h')
+    children = []
+    leaves = array('h')
+    labels = []
+    thresholds = []
+    label_codes = {}
+    nodes = [id3_tree]
+    node_index = 0
+    while node_index < len(nodes):
+        node = nodes[node_index]
+        node_index += 1
+        if isinstance(node, str):
+            if node not in label_codes:
+                label_codes[node] = len(labels)
+                labels.append(node)
+            features.append(LEAF)
+            children.append(None)
+            leaves.append(label_codes[node])
+            thresholds.append(None)
+            continue
+        node_children = {}
+        feature = LEAF
+        threshold = None
+        for tree_key, subtree in node.items():
+            key_parts = tree_key.split(SEPARATOR)
+            feature = headers.index(key_parts[0])
+            if len(key_parts) == 3:
+                threshold = float(key_parts[2])
+                node_children[key_parts[1] == GREATER] = len(nodes)
+            else:
+                node_children[key_parts[1]] = len(nodes)
+            nodes.append(subtree)
+        if threshold is not None:
+            node_children = array('i', [
+                node_children.get(False, LEAF), node_children.get(True, LEAF)
+            ])
+        elif vocabularies is not None:
+            node_children = array('i', [
+                node_children.get(value, LEAF)
+                for value in vocabularies[feature]
+            ])
+        features.append(feature)
+        children.append(node_children)
+        leaves.append(LEAF)
+        thresholds.append(threshold)
+    return CompiledTree(headers, features, children, leaves, labels,
+                        thresholds)
+
+
+def get_child_nodes(compiled_tree, node):
+    node_children = compiled_tree.children[node]
+    if isinstance(node_children, dict):
+        return list(node_children.values())
+    return [child for child in node_children if child != LEAF]
+
+
+def _get_children_keys(compiled_tree, node, vocabularies):
+    attribute = compiled_tree.attributes[compiled_tree.features[node]]
+    node_children = compiled_tree.children[node]
+    threshold = compiled_tree.thresholds[node]
+    if threshold is not None:
+        return [
+            (tree_key, child) for tree_key, child in zip(
+                get_threshold_keys(attribute, threshold), node_children
+            ) if child != LEAF
+        ]
+    if not isinstance(node_children, dict):
+        vocabulary = vocabularies[compiled_tree.features[node]]
+        node_children = {
+            vocabulary[value]: child
+            for value, child in enumerate(node_children) if child != LEAF
+        }
+    return [
+        (attribute + SEPARATOR + value, child)
+        for value, child in node_children.items()
+    ]
+
+
+def decompile_tree(compiled_tree, vocabularies=None):
+    features = compiled_tree.features
+    leaves = compiled_tree.leaves
+    labels = compiled_tree.labels
+    if features[0] == LEAF:
+        return labels[leaves[0]]
+    id3_tree = {}
+    nodes = [(0, id3_tree)]
+    while nodes:
+        node, id3_subtree = nodes.pop()
+        for tree_key, child in _get_children_keys(
+                compiled_tree, node, vocabularies
+        ):
+            if features[child] == LEAF:
+                id3_subtree[tree_key] = labels[leaves[child]]
+            else:
+                id3_subtree[tree_key] = {}
+                nodes.append((child, id3_subtree[tree_key]))
+    return id3_tree
+
+
+def predict_row(compiled_tree, row):
+    features = compiled_tree.features
+    children = compiled_tree.children
+    node = 0
+    feature = features[0]
+    thresholds = compiled_tree.thresholds
+    while feature != LEAF:
+        threshold = thresholds[node]
+        if threshold is None:
+            node = children[node].get(row[feature], LEAF)
+        else:
+            node = children[node][float(row[feature]) > threshold]
+        if node == LEAF:
+            return None
+        feature = features[node]
+    return compiled_tree.labels[compiled_tree.leaves[node]]
+
+
+def predict_encoded_row(compiled_tree, columns, index):
+    features = compiled_tree.features
+    children = compiled_tree.children
+    node = 0
+    feature = features[0]
+    thresholds = compiled_tree.thresholds
+    while feature != LEAF:
+        threshold = thresholds[node]
+        if threshold is None:
+            node = children[node][columns[feature][index]]
+        else:
+            node = children[node][columns[feature][index] > threshold]
+        if node == LEAF:
+            return None
+        feature = features[node]
+    return compiled_tree.labels[compiled_tree.leaves[node]]
+
+
+def _route_positions(compiled_tree, positions_count, get_values):
+    features = compiled_tree.features
+    children = compiled_tree.children
+    thresholds = compiled_tree.thresholds
+    level = [(0, range(positions_count))]
+    while level:
+        next_level = []
+        for node, positions in level:
+            yield node, positions
+            feature = features[node]
+            if feature == LEAF:
+                continue
+            node_children = children[node]
+            threshold = thresholds[node]
+            if threshold is not None:
+                def lookup_child(value, node_children=node_children,
+                                 threshold=threshold):
+                    return node_children[float(value) > threshold]
+            elif isinstance(node_children, dict):
+                lookup_child = node_children.get
+            else:
+                lookup_child = node_children.__getitem__
+            groups = {}
+            for child, position in zip(
+                    map(lookup_child, get_values(feature, positions)),
+                    positions
+            ):
+                if child is not None and child != LEAF:
+                    groups.setdefault(child, []).append(position)
+            next_level.extend(groups.items())
+        level = next_level
+
+
+def route_batch(compiled_tree, rows):
+    def get_values(feature, positions):
+        return [rows[position][feature] for position in positions]
+    return _route_positions(compiled_tree, len(rows), get_values)
+
+
+def route_encoded_batch(compiled_tree, columns, indexes):
+    def get_values(feature, positions):
+        column = columns[feature]
+        return [column[indexes[position]] for position in positions]
+    return _route_positions(compiled_tree, len(indexes), get_values)
+
+
+def predict_batch(compiled_tree, rows):
+    # One walk of the compiled arrays per row: in pure Python this is
+    # cheaper than grouping the rows per node level by level, which only
+    # pays off for callers that need the rows of every node.
+    return [predict_row(compiled_tree, row) for row in rows]
+
+
+def predict_encoded_batch(compiled_tree, columns, indexes):
+    return [
+        predict_encoded_row(compiled_tree, columns, index)
+        for index in indexes
+    ]
+
+
+def create_score(predictions, actuals):
+    confusion_matrix = {}
+    success = 0
+    for actual, predicted in zip(actuals, predictions):
+        actual_row = confusion_matrix.setdefault(actual, {})
+        actual_row[predicted] = actual_row.get(predicted, 0) + 1
+        if actual == predicted:
+            success += 1
+    accuracy = success / len(predictions) if predictions else 0
+    return predictions, confusion_matrix, accuracy
+
+
+def score(compiled_tree, rows, decision_index):
+    profiling.count('accuracy_evaluations')
+    profiling.count('rows_scored', len(rows))
+    with profiling.phase('score'):
+        predictions = predict_batch(compiled_tree, rows)
+    return create_score(
+        predictions, [row[decision_index] for row in rows]
+    )
+
+
+def score_encoded(compiled_tree, vocabularies, columns, decision_index,
+                  indexes):
+    profiling.count('accuracy_evaluations')
+    profiling.count('rows_scored', len(indexes))
+    with profiling.phase('score'):
+        predictions = predict_encoded_batch(compiled_tree, columns, indexes)
+    decision_column = columns[decision_index]
+    decision_vocabulary = vocabularies[decision_index]
+    return create_score(predictions, [
+        decision_vocabulary[decision_column[index]] for index in indexes
+    ])
+
+
+def count_success(confusion_matrix):
+    return sum(
+        actual_row.get(actual, 0)
+        for actual, actual_row in confusion_matrix.items()
+    )
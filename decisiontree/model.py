@@ -0,0 +1,271 @@
+import json
+import mmap
+import struct
+
+from array import array
+from collections import namedtuple
+
+from decisiontree.inference import (LEAF, SEPARATOR, CompiledTree,
+                                    compile_tree, decompile_tree)
+from decisiontree.utils import replace_file
+
+MODEL_MAGIC = b'DTMODEL1'
+MODEL_VERSION = 1
+MODEL_ALIGNMENT = 8
+HEADER_LENGTH_FORMAT = '<Q'
+SECTIONS = [
+    ('features', 'h'),
+    ('leaves', 'h'),
+    ('thresholds', 'd'),
+    ('child_offsets', 'I'),
+    ('child_table', 'i'),
+]
+
+Model = namedtuple('Model', ['compiled_tree', 'vocabularies'])
+
+
+class _ChildTables:
+    # Node child tables as slices of one flat table, so a mapped model
+    # never builds a Python object per node.
+
+    def __init__(self, child_offsets, child_table):
+        self.child_offsets = child_offsets
+        self.child_table = child_table
+
+    def __len__(self):
+        return len(self.child_offsets) - 1
+
+    def __getitem__(self, node):
+        if not 0 <= node < len(self):
+            raise IndexError(node)
+        start = self.child_offsets[node]
+        end = self.child_offsets[node + 1]
+        if start == end:
+            return None
+        return self.child_table[start:end]
+
+
+class _Thresholds:
+    # NaN marks the nodes without a threshold.
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, node):
+        threshold = self.values[node]
+        if threshold != threshold:
+            return None
+        return threshold
+
+
+def _align(offset):
+    return (offset + MODEL_ALIGNMENT - 1) // MODEL_ALIGNMENT * MODEL_ALIGNMENT
+
+
+def _collect_vocabularies(id3_tree, headers):
+    # Every categorical value used by the tree is interned once, in order
+    # of first appearance.
+    vocabularies = [None] * len(headers)
+    nodes = [id3_tree]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, str):
+            continue
+        for tree_key, subtree in node.items():
+            key_parts = tree_key.split(SEPARATOR)
+            if len(key_parts) == 2:
+                feature = headers.index(key_parts[0])
+                if vocabularies[feature] is None:
+                    vocabularies[feature] = []
+                if key_parts[1] not in vocabularies[feature]:
+                    vocabularies[feature].append(key_parts[1])
+            nodes.append(subtree)
+    return vocabularies
+
+
+def create_model(id3_tree, headers):
+    vocabularies = _collect_vocabularies(id3_tree, headers)
+    return Model(compile_tree(id3_tree, headers, vocabularies), vocabularies)
+
+
+def _get_sections(compiled_tree):
+    # Categorical child tables get a trailing LEAF slot that values
+    # missing from the vocabulary are routed to.
+    child_offsets = array('I', [0])
+    child_table = array('i')
+    for node, node_children in enumerate(compiled_tree.children):
+        if node_children is not None:
+            child_table.extend(node_children)
+            if compiled_tree.thresholds[node] is None:
+                child_table.append(LEAF)
+        child_offsets.append(len(child_table))
+    return {
+        'features': compiled_tree.features,
+        'leaves': compiled_tree.leaves,
+        'thresholds': [
+            float('nan') if threshold is None else threshold
+            for threshold in compiled_tree.thresholds
+        ],
+        'child_offsets': child_offsets,
+        'child_table': child_table,
+    }
+
+
+def write_model(model, file_name):
+    compiled_tree, vocabularies = model
+    sections = _get_sections(compiled_tree)
+    sections_header = {}
+    offset = 0
+    for section_name, typecode in SECTIONS:
+        section = array(typecode, sections[section_name])
+        sections[section_name] = section
+        sections_header[section_name] = {
+            'offset': offset, 'length': len(section)
+        }
+        offset = _align(offset + len(section) * section.itemsize)
+    header = json.dumps({
+        'version': MODEL_VERSION,
+        'attributes': compiled_tree.attributes,
+        'vocabularies': vocabularies,
+        'labels': compiled_tree.labels,
+        'sections': sections_header,
+    }).encode('utf-8')
+    data_start = _align(
+        len(MODEL_MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT) + len(header)
+    )
+    # A new file replaces the old one, whose pages stay valid for readers
+    # that still have it mapped.
+    with replace_file(file_name) as model_file:
+        model_file.write(MODEL_MAGIC)
+        model_file.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)))
+        model_file.write(header)
+        for section_name, _ in SECTIONS:
+            model_file.seek(
+                data_start + sections_header[section_name]['offset']
+            )
+            sections[section_name].tofile(model_file)
+        model_file.truncate(data_start + offset)
+
+
+def read_model(file_name):
+    # Only the header is parsed: the node arrays are zero-copy views over
+    # a read-only mapping shared by every process that loads the model.
+    # Its compiled tree takes columns encoded with the model vocabularies
+    # (translate_columns); raw rows go through predict_model_batch.
+    with open(file_name, 'rb') as model_file:
+        model_map = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+    model_view = memoryview(model_map)
+    if bytes(model_view[:len(MODEL_MAGIC)]) != MODEL_MAGIC:
+        raise ValueError('{} is not a decision tree model'.format(file_name))
+    header_start = len(MODEL_MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT)
+    header_length, = struct.unpack_from(
+        HEADER_LENGTH_FORMAT, model_view, len(MODEL_MAGIC)
+    )
+    header = json.loads(
+        bytes(model_view[header_start:header_start + header_length])
+    )
+    if header['version'] != MODEL_VERSION:
+        raise ValueError('Unsupported model version {} in {}'.format(
+            header['version'], file_name
+        ))
+    data_start = _align(header_start + header_length)
+    sections = {}
+    for section_name, typecode in SECTIONS:
+        section_header = header['sections'][section_name]
+        start = data_start + section_header['offset']
+        end = start + section_header['length'] * array(typecode).itemsize
+        sections[section_name] = model_view[start:end].cast(typecode)
+    compiled_tree = CompiledTree(
+        header['attributes'], sections['features'],
+        _ChildTables(sections['child_offsets'], sections['child_table']),
+        sections['leaves'], header['labels'],
+        _Thresholds(sections['thresholds'])
+    )
+    return Model(compiled_tree, header['vocabularies'])
+
+
+def get_numeric_features(model):
+    thresholds = model.compiled_tree.thresholds
+    return sorted({
+        feature
+        for node, feature in enumerate(model.compiled_tree.features)
+        if feature != LEAF and thresholds[node] is not None
+    })
+
+
+def predict_model_batch(model, rows):
+    # Raw rows, with their categorical values looked up in the model
+    # vocabularies; values the model has never seen take the trailing LEAF
+    # slot of their node.
+    compiled_tree = model.compiled_tree
+    features = compiled_tree.features
+    children = compiled_tree.children
+    thresholds = compiled_tree.thresholds
+    leaves = compiled_tree.leaves
+    labels = compiled_tree.labels
+    value_codes = [
+        None if vocabulary is None else
+        {value: code for code, value in enumerate(vocabulary)}
+        for vocabulary in model.vocabularies
+    ]
+    predictions = []
+    for row in rows:
+        node = 0
+        feature = features[0]
+        while feature != LEAF:
+            threshold = thresholds[node]
+            if threshold is None:
+                codes = value_codes[feature]
+                node = children[node][codes.get(row[feature], len(codes))]
+            else:
+                node = children[node][float(row[feature]) > threshold]
+            if node == LEAF:
+                break
+            feature = features[node]
+        predictions.append(None if node == LEAF else labels[leaves[node]])
+    return predictions
+
+
+def predict_model_row(model, row):
+    return predict_model_batch(model, [row])[0]
+
+
+def model_to_id3_tree(model):
+    return decompile_tree(model.compiled_tree, model.vocabularies)
+
+
+def translate_columns(model, vocabularies, columns):
+    # Re-encode dataset columns with the model vocabularies; values the
+    # model has never seen get the code of the trailing LEAF slot.
+    translated_columns = list(columns)
+    for feature, model_vocabulary in enumerate(model.vocabularies):
+        if model_vocabulary is None or feature >= len(columns):
+            continue
+        model_codes = {
+            value: code for code, value in enumerate(model_vocabulary)
+        }
+        translation = [
+            model_codes.get(value, len(model_vocabulary))
+            for value in vocabularies[feature]
+        ]
+        translated_columns[feature] = array(
+            'I', map(translation.__getitem__, columns[feature])
+        )
+    return translated_columns
+
+
+def convert_json_to_model(json_file_name, model_file_name, headers):
+    with open(json_file_name, 'r') as json_file:
+        id3_tree = json.loads(json_file.read())
+    write_model(create_model(id3_tree, headers), model_file_name)
+
+
+def convert_model_to_json(model_file_name, json_file_name):
+    # Replaced like every tree file, since a server may be reloading it.
+    with replace_file(json_file_name, 'w') as json_file:
+        json_file.write(json.dumps(model_to_id3_tree(read_model(
+            model_file_name
+        ))))
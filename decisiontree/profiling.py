@@ -0,0 +1,107 @@
+import contextlib
+import json
+import os
+import time
+
+from collections import Counter
+
+# Instrumentation is off unless enable() is called; phase() and count()
+# then cost one global lookup and a branch.
+enabled = False
+counters = Counter()
+phase_totals = {}
+events = []
+started = None
+
+_NULL_PHASE = contextlib.nullcontext()
+
+
+def enable():
+    global enabled, started
+    reset()
+    enabled = True
+    started = time.perf_counter()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    counters.clear()
+    phase_totals.clear()
+    del events[:]
+
+
+def count(name, value=1):
+    if enabled:
+        counters[name] += value
+
+
+@contextlib.contextmanager
+def _record_phase(name):
+    phase_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_end = time.perf_counter()
+        calls, seconds = phase_totals.get(name, (0, 0))
+        phase_totals[name] = (calls + 1, seconds + phase_end - phase_start)
+        events.append((name, phase_start, phase_end))
+
+
+def phase(name):
+    if not enabled:
+        return _NULL_PHASE
+    return _record_phase(name)
+
+
+def get_summary():
+    return {
+        'phases': {
+            name: {'calls': calls, 'seconds': seconds}
+            for name, (calls, seconds) in sorted(
+                phase_totals.items(), key=lambda item: -item[1][1]
+            )
+        },
+        'counters': dict(sorted(counters.items())),
+    }
+
+
+def format_summary():
+    lines = ['{:<32} {:>10} {:>12}'.format('phase', 'calls', 'seconds')]
+    for name, (calls, seconds) in sorted(
+            phase_totals.items(), key=lambda item: -item[1][1]
+    ):
+        lines.append('{:<32} {:>10} {:>12.6f}'.format(name, calls, seconds))
+    lines.append('{:<32} {:>23}'.format('counter', 'value'))
+    for name, value in sorted(counters.items()):
+        lines.append('{:<32} {:>23}'.format(name, value))
+    return '\n'.join(lines)
+
+
+def write_summary(file_name):
+    with open(file_name, 'w') as summary_file:
+        summary_file.write(json.dumps(get_summary(), indent=2))
+
+
+def write_chrome_trace(file_name):
+    # Complete ("X") events in microseconds, loadable in chrome://tracing
+    # and Perfetto, with the final counters as one counter event.
+    process_id = os.getpid()
+    trace_events = [
+        {
+            'name': name, 'ph': 'X', 'pid': process_id, 'tid': 0,
+            'ts': (phase_start - started) * 1e6,
+            'dur': (phase_end - phase_start) * 1e6,
+        }
+        for name, phase_start, phase_end in events
+    ]
+    trace_events.append({
+        'name': 'counters', 'ph': 'C', 'pid': process_id, 'tid': 0,
+        'ts': (time.perf_counter() - started) * 1e6,
+        'args': dict(counters),
+    })
+    with open(file_name, 'w') as trace_file:
+        trace_file.write(json.dumps({'traceEvents': trace_events}))
@@ -0,0 +1,101 @@
+from array import array
+from collections import Counter
+
+from decisiontree import profiling
+
+from decisiontree.inference import (LEAF, CompiledTree, get_child_nodes,
+                                    route_encoded_batch)
+
+
+def count_encoded_node_decisions(compiled_tree, vocabularies, columns,
+                                 decision_index, indexes=None):
+    if indexes is None:
+        indexes = range(len(columns[decision_index]))
+    decision_column = columns[decision_index]
+    decision_vocabulary = vocabularies[decision_index]
+    profiling.count('accuracy_evaluations')
+    profiling.count('rows_scored', len(indexes))
+    node_counts = [Counter() for _ in compiled_tree.features]
+    with profiling.phase('count_node_decisions'):
+        for node, positions in route_encoded_batch(
+                compiled_tree, columns, indexes
+        ):
+            node_counts[node].update(
+                decision_vocabulary[decision_column[indexes[position]]]
+                for position in positions
+            )
+    return node_counts
+
+
+def prune_compiled_tree(compiled_tree, datasets_node_counts, leaf_labels,
+                        report_collapse=None):
+    # Reduced-error pruning driven by cached per-node label counts: the
+    # first entry of datasets_node_counts decides, the others are only
+    # tracked to report their accuracy after every collapse.
+    features = array('h', compiled_tree.features)
+    children = list(compiled_tree.children)
+    leaves = array('h', compiled_tree.leaves)
+    labels = list(compiled_tree.labels)
+    thresholds = list(compiled_tree.thresholds)
+    label_codes = {label: code for code, label in enumerate(labels)}
+    profiling.count('prune_candidates', len(features))
+
+    descendants = [0] * len(features)
+    size = len(features) - 1
+    totals = []
+    total_corrects = []
+    for node_counts in datasets_node_counts:
+        totals.append(sum(node_counts[0].values()))
+        total_corrects.append(sum(
+            node_counts[node][labels[leaves[node]]]
+            for node in range(len(features)) if features[node] == LEAF
+        ))
+    corrects = [[0] * len(features) for _ in datasets_node_counts]
+
+    # Children are always compiled after their parent, so walking the node
+    # indexes backwards visits every subtree before the node that owns it.
+    for node in reversed(range(len(features))):
+        if features[node] == LEAF:
+            label = labels[leaves[node]]
+            for dataset, node_counts in enumerate(datasets_node_counts):
+                corrects[dataset][node] = node_counts[node][label]
+            continue
+        node_children = get_child_nodes(compiled_tree, node)
+        for dataset_corrects in corrects:
+            dataset_corrects[node] = sum(
+                dataset_corrects[child] for child in node_children
+            )
+        descendants[node] = sum(
+            1 + descendants[child] for child in node_children
+        )
+        validation_counts = datasets_node_counts[0][node]
+        best_label = None
+        for label in leaf_labels:
+            if (best_label is None or validation_counts[label]
+                    > validation_counts[best_label]):
+                best_label = label
+        if validation_counts[best_label] <= corrects[0][node]:
+            continue
+
+        if best_label not in label_codes:
+            label_codes[best_label] = len(labels)
+            labels.append(best_label)
+        size -= descendants[node]
+        descendants[node] = 0
+        features[node] = LEAF
+        children[node] = None
+        leaves[node] = label_codes[best_label]
+        thresholds[node] = None
+        for dataset, node_counts in enumerate(datasets_node_counts):
+            leaf_correct = node_counts[node][best_label]
+            total_corrects[dataset] += leaf_correct - corrects[dataset][node]
+            corrects[dataset][node] = leaf_correct
+        if report_collapse is not None:
+            report_collapse([
+                total_correct / total if total else 0
+                for total_correct, total in zip(total_corrects, totals)
+            ], size)
+    return CompiledTree(
+        compiled_tree.attributes, features, children, leaves, labels,
+        thresholds
+    )
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import signal
+import time
+
+from collections import deque
+
+from decisiontree.inference import compile_tree, predict_batch
+
+HOST = '127.0.0.1'
+PORT = 8050
+BATCH_DELAY = 0.002
+MAX_BATCH_ROWS = 4096
+RELOAD_INTERVAL = 1.0
+LATENCY_SAMPLES = 10000
+MAX_LINE_BYTES = 64 * 1024 * 1024
+# Connections waiting to be accepted, for bursts of clients connecting
+# at once.
+BACKLOG = 1024
+
+
+def _get_file_signature(file_name):
+    file_stat = os.stat(file_name)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _get_percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(
+        len(sorted_values) - 1, int(fraction * len(sorted_values))
+    )]
+
+
+async def _read_line(reader):
+    # Like readline, but a line over the reader limit is skipped up to its
+    # newline and returned as None, so the connection stays usable.
+    oversize = False
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as error:
+            line = error.partial
+        except asyncio.LimitOverrunError as error:
+            await reader.readexactly(error.consumed)
+            oversize = True
+            continue
+        if oversize:
+            return None
+        return line
+
+
+class PredictionServer:
+    # Serves predictions as JSON lines: {"row": [...]} or {"rows": [...]}
+    # are answered with {"prediction": ...} or {"predictions": [...]} and
+    # {"stats": true} with the counters. Requests arriving within
+    # batch_delay of each other are predicted as one batch.
+
+    def __init__(self, tree_file_name, headers, batch_delay=BATCH_DELAY,
+                 max_batch_rows=MAX_BATCH_ROWS,
+                 reload_interval=RELOAD_INTERVAL):
+        self.tree_file_name = tree_file_name
+        self.headers = headers
+        self.batch_delay = batch_delay
+        self.max_batch_rows = max_batch_rows
+        self.reload_interval = reload_interval
+        self.compiled_tree = None
+        self.signature = None
+        self.pending = None
+        self.started = time.monotonic()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.reloads = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def _read_model(self):
+        signature = _get_file_signature(self.tree_file_name)
+        with open(self.tree_file_name, 'r') as id3_file:
+            id3_tree = json.loads(id3_file.read())
+        return compile_tree(id3_tree, self.headers), signature
+
+    def load_model(self):
+        self.compiled_tree, self.signature = self._read_model()
+
+    async def _watch_model(self):
+        # The new tree is compiled off the event loop and swapped in with
+        # one assignment, so every batch sees a single model.
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if _get_file_signature(self.tree_file_name) == self.signature:
+                    continue
+                self.compiled_tree, self.signature = (
+                    await loop.run_in_executor(None, self._read_model)
+                )
+                self.reloads += 1
+            except (OSError, ValueError):
+                # Missing or half-written file: keep serving the old tree.
+                self.errors += 1
+
+    def _predict_requests(self, requests):
+        compiled_tree = self.compiled_tree
+        try:
+            predictions = predict_batch(compiled_tree, [
+                row for rows, _ in requests for row in rows
+            ])
+        except Exception:
+            # A malformed row only fails its own request.
+            for rows, future in requests:
+                self._predict_requests_alone(compiled_tree, rows, future)
+            return
+        start = 0
+        for rows, future in requests:
+            if not future.done():
+                future.set_result(predictions[start:start + len(rows)])
+            start += len(rows)
+
+    def _predict_requests_alone(self, compiled_tree, rows, future):
+        try:
+            predictions = predict_batch(compiled_tree, rows)
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+            return
+        if not future.done():
+            future.set_result(predictions)
+
+    async def _batch_predictions(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.pending.get()]
+            rows_count = len(requests[0][0])
+            deadline = loop.time() + self.batch_delay
+            while rows_count < self.max_batch_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(
+                        self.pending.get(), timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                rows_count += len(request[0])
+            self._predict_requests(requests)
+            self.batches += 1
+
+    async def _handle_request(self, line):
+        started = time.perf_counter()
+        try:
+            request = json.loads(line)
+            if request.get('stats'):
+                return self.get_stats()
+            single = 'row' in request
+            rows = [request['row']] if single else list(request['rows'])
+            future = asyncio.get_running_loop().create_future()
+            await self.pending.put((rows, future))
+            predictions = await future
+        except Exception as error:
+            self.errors += 1
+            return {'error': repr(error)}
+        self.latencies.append(time.perf_counter() - started)
+        self.requests += 1
+        self.rows += len(rows)
+        if single:
+            return {'prediction': predictions[0]}
+        return {'predictions': predictions}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await _read_line(reader)
+                if line is None:
+                    self.errors += 1
+                    response = {'error': 'request line over {} bytes'.format(
+                        MAX_LINE_BYTES
+                    )}
+                elif not line:
+                    break
+                else:
+                    response = await self._handle_request(line)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def get_stats(self):
+        latencies = sorted(self.latencies)
+        uptime = time.monotonic() - self.started
+        return {
+            'requests': self.requests,
+            'rows': self.rows,
+            'batches': self.batches,
+            'reloads': self.reloads,
+            'errors': self.errors,
+            'uptime': uptime,
+            'requests_per_second': self.requests / uptime,
+            'rows_per_second': self.rows / uptime,
+            'latency_p50': _get_percentile(latencies, 0.5),
+            'latency_p99': _get_percentile(latencies, 0.99),
+        }
+
+    async def serve(self, socket_path=None, host=HOST, port=PORT):
+        self.load_model()
+        self.pending = asyncio.Queue()
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(
+                self._handle_connection, socket_path, limit=MAX_LINE_BYTES,
+                backlog=BACKLOG
+            )
+        else:
+            server = await asyncio.start_server(
+                self._handle_connection, host, port, limit=MAX_LINE_BYTES,
+                backlog=BACKLOG
+            )
+        tasks = [
+            asyncio.ensure_future(self._batch_predictions()),
+            asyncio.ensure_future(self._watch_model()),
+        ]
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stopped.set)
+        try:
+            async with server:
+                await stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def serve_predictions(tree_file_name, headers, socket_path=None, host=HOST,
+                      port=PORT):
+    server = PredictionServer(tree_file_name, headers)
+    try:
+        asyncio.run(server.serve(socket_path, host, port))
+    finally:
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return server.get_stats()
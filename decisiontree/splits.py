@@ -0,0 +1,132 @@
+import json
+import struct
+
+from array import array
+from random import Random
+
+from decisiontree.utils import (get_array_typecode, get_source_signature,
+                                replace_file)
+
+SPLIT_SUFFIX = '.split'
+FOLDS_SUFFIX = '.folds'
+SPLIT_MAGIC = b'DTSPLIT1'
+SPLIT_VERSION = 2
+HEADER_LENGTH_FORMAT = '<Q'
+
+
+def get_split_file_name(file_name):
+    return file_name + SPLIT_SUFFIX
+
+
+def get_folds_file_name(file_name):
+    return file_name + FOLDS_SUFFIX
+
+
+def _shuffle_by_label(label_column, seed=None):
+    # One shuffled list of row indexes per label, labels in order of first
+    # appearance, so every split below takes its share of each label.
+    buckets = {}
+    for index, label in enumerate(label_column):
+        bucket = buckets.get(label)
+        if bucket is None:
+            bucket = buckets[label] = []
+        bucket.append(index)
+    random = Random(seed)
+    for bucket in buckets.values():
+        random.shuffle(bucket)
+    return buckets.values()
+
+
+def _create_assignments(rows_count, split_count):
+    return array(get_array_typecode(split_count), [0]) * rows_count
+
+
+def assign_folds(label_column, fold_number, seed=None):
+    # Rows are dealt to the folds in turn across all labels, so fold sizes
+    # differ by at most one and every fold keeps the label proportions.
+    assignments = _create_assignments(len(label_column), fold_number)
+    position = 0
+    for bucket in _shuffle_by_label(label_column, seed):
+        for index in bucket:
+            assignments[index] = position % fold_number
+            position += 1
+    return assignments
+
+
+def assign_splits(label_column, fractions, seed=None):
+    # fractions are relative sizes, e.g. [0.7, 0.15, 0.15] for training,
+    # validation and test, and are cut from every label separately.
+    assignments = _create_assignments(len(label_column), len(fractions))
+    total_fraction = sum(fractions)
+    for bucket in _shuffle_by_label(label_column, seed):
+        start = 0
+        cumulative_fraction = 0
+        for split, fraction in enumerate(fractions):
+            cumulative_fraction += fraction
+            end = round(len(bucket) * cumulative_fraction / total_fraction)
+            for index in bucket[start:end]:
+                assignments[index] = split
+            start = end
+    return assignments
+
+
+def get_split_indexes(assignments, split_count):
+    # A single pass over the assignments, so every split comes out in file
+    # order.
+    splits = [array('I') for _ in range(split_count)]
+    appends = [split.append for split in splits]
+    for index, split in enumerate(assignments):
+        appends[split](index)
+    return splits
+
+
+def write_split_file(file_name, assignments, names, options=None,
+                     source_file_name=None):
+    # source_file_name is the file whose rows were assigned, so the split is
+    # dropped once that file changes even if its row count does not.
+    header = json.dumps({
+        'version': SPLIT_VERSION,
+        'source': None if source_file_name is None else get_source_signature(
+            source_file_name
+        ),
+        'rows': len(assignments),
+        'names': names,
+        'options': options,
+        'typecode': assignments.typecode,
+    }).encode('utf-8')
+    with replace_file(file_name) as split_file:
+        split_file.write(SPLIT_MAGIC)
+        split_file.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)))
+        split_file.write(header)
+        assignments.tofile(split_file)
+
+
+def read_split_file(file_name, rows_count=None, options=None,
+                    source_file_name=None):
+    # Returns the split names and the split of every row, or None when the
+    # file is missing or was written for other rows, other options or
+    # another version of source_file_name.
+    try:
+        with open(file_name, 'rb') as split_file:
+            if split_file.read(len(SPLIT_MAGIC)) != SPLIT_MAGIC:
+                return None
+            header_length, = struct.unpack(
+                HEADER_LENGTH_FORMAT,
+                split_file.read(struct.calcsize(HEADER_LENGTH_FORMAT))
+            )
+            header = json.loads(split_file.read(header_length))
+            if (header['version'] != SPLIT_VERSION
+                    or rows_count is not None
+                    and header['rows'] != rows_count
+                    or options is not None
+                    and header['options'] != options
+                    or source_file_name is not None
+                    and header['source'] != get_source_signature(
+                        source_file_name
+                    )):
+                return None
+            assignments = array(header['typecode'])
+            assignments.fromfile(split_file, header['rows'])
+    except (OSError, EOFError, KeyError, ValueError):
+        return None
+    return header['names'], assignments
@@ -0,0 +1,306 @@
+from collections import Counter, namedtuple
+from itertools import islice
+
+from decisiontree import profiling
+from decisiontree.id3_algorithm import (COUNT_BITS, COUNT_MASK,
+                                        calculate_split_information_gain,
+                                        entropy)
+from decisiontree.inference import SEPARATOR, get_threshold_keys
+from decisiontree.utils import iter_csv_chunks
+
+STREAM_CHUNK_SIZE = 8192
+LEAF = -1
+
+
+def iter_csv_column_chunks(file_name, numeric_indexes=(), exclude_flag=None,
+                           chunk_size=STREAM_CHUNK_SIZE):
+    # Chunks of rows turned into columns, numeric ones as floats.
+    for chunk in iter_csv_chunks(file_name, chunk_size, exclude_flag):
+        columns = list(zip(*chunk))
+        for column_index in numeric_indexes:
+            columns[column_index] = list(map(float, columns[column_index]))
+        yield columns
+
+
+def iter_column_chunks(columns, chunk_size=STREAM_CHUNK_SIZE):
+    # Slices of memory-mapped cache columns are views, so a pass only
+    # keeps the pages of the chunk being read.
+    rows_count = len(columns[0]) if columns else 0
+    for start in range(0, rows_count, chunk_size):
+        yield [column[start:start + chunk_size] for column in columns]
+
+
+class _PartialTree:
+    # The tree trained so far as flat per-node lists like CompiledTree.
+    # Split nodes route on features, thresholds and children; LEAF nodes
+    # are either finished or waiting for the next pass in open_nodes.
+
+    def __init__(self):
+        self.features = []
+        self.thresholds = []
+        self.children = []
+        self.subtrees = []
+        self.open_nodes = {}
+
+    def add_node(self, parent_subtree, tree_key):
+        self.features.append(LEAF)
+        self.thresholds.append(None)
+        self.children.append(None)
+        self.subtrees.append((parent_subtree, tree_key))
+        return len(self.features) - 1
+
+    def route_chunk(self, chunk, positions_count, counted_nodes):
+        # Returns the chunk positions that reach every counted node.
+        features = self.features
+        thresholds = self.thresholds
+        children = self.children
+        routed = {}
+        level = [(0, range(positions_count))]
+        while level:
+            next_level = []
+            for node, positions in level:
+                feature = features[node]
+                if feature == LEAF:
+                    if node in counted_nodes:
+                        routed[node] = positions
+                    continue
+                node_children = children[node]
+                threshold = thresholds[node]
+                column = chunk[feature]
+                groups = {}
+                if threshold is None:
+                    for position in positions:
+                        child = node_children.get(column[position])
+                        if child is not None:
+                            groups.setdefault(child, []).append(position)
+                else:
+                    for position in positions:
+                        groups.setdefault(
+                            node_children[column[position] > threshold], []
+                        ).append(position)
+                next_level.extend(groups.items())
+            level = next_level
+        return routed
+
+
+def add_label_increments(label_increments, labels, class_labels):
+    # Labels get class codes, and lanes, in order of first appearance.
+    for label in dict.fromkeys(labels):
+        if label not in label_increments:
+            class_labels.append(label)
+            label_increments[label] = 1 + (
+                1 << (COUNT_BITS * len(class_labels))
+            )
+    return label_increments
+
+
+def _count_pass(context, partial_tree, iter_chunks, counted_nodes):
+    # One sequential pass: every counted node gets one count table per
+    # attribute, value -> packed class counts, with values in order of
+    # first appearance in the stream.
+    attribute_indexes = context.attribute_indexes
+    label_increments = context.label_increments
+    node_tables = {node: [{} for _ in attribute_indexes]
+                   for node in counted_nodes}
+    for chunk in iter_chunks():
+        label_column = chunk[context.decision_index]
+        add_label_increments(
+            label_increments, label_column, context.class_labels
+        )
+        profiling.count('rows_streamed', len(label_column))
+        for node, positions in partial_tree.route_chunk(
+                chunk, len(label_column), node_tables
+        ).items():
+            labels = [label_column[position] for position in positions]
+            for attribute_table, attribute_index in zip(
+                    node_tables[node], attribute_indexes
+            ):
+                column = chunk[attribute_index]
+                for (value, label), count in Counter(zip(
+                        map(column.__getitem__, positions), labels
+                )).items():
+                    attribute_table[value] = (
+                        attribute_table.get(value, 0)
+                        + count * label_increments[label]
+                    )
+    return node_tables
+
+
+def _find_best_threshold(attribute_table, total_entropy, class_counts):
+    # The same sweep as the in-memory trainer, over distinct values.
+    total = class_counts & COUNT_MASK
+    max_information_gain = None
+    best_threshold = None
+    best_counts = None
+    left_counts = 0
+    values = sorted(attribute_table)
+    for value, next_value in zip(values, values[1:]):
+        left_counts += attribute_table[value]
+        right_counts = class_counts - left_counts
+        left_total = left_counts & COUNT_MASK
+        right_total = total - left_total
+        information_gain = (
+            total_entropy
+            - (left_total / total) * entropy(left_counts)
+            - (right_total / total) * entropy(right_counts)
+        )
+        if (max_information_gain is None
+                or information_gain > max_information_gain):
+            max_information_gain = information_gain
+            best_threshold = value
+            best_counts = (left_counts, right_counts)
+    if max_information_gain is None:
+        return 0, None, None
+    return max_information_gain, best_threshold, best_counts
+
+
+def _get_value_name(vocabularies, column_index, value):
+    if vocabularies is None or vocabularies[column_index] is None:
+        return value
+    return vocabularies[column_index][value]
+
+
+def get_majority_label(context, class_counts):
+    max_count = 0
+    majority_label = None
+    for label in context.class_labels:
+        class_counts >>= COUNT_BITS
+        class_count = class_counts & COUNT_MASK
+        if class_count > max_count:
+            max_count = class_count
+            majority_label = label
+    return _get_value_name(
+        context.vocabularies, context.decision_index, majority_label
+    )
+
+
+def is_open_node(context, class_counts, depth):
+    return ((context.max_depth is None or depth < context.max_depth)
+            and (class_counts & COUNT_MASK) >= context.min_samples_split
+            and entropy(class_counts) > 0)
+
+
+def select_split(context, attribute_tables, class_counts):
+    # The best split of a node from its count tables, as the attribute
+    # position, its threshold and the counts of both sides for numeric
+    # attributes, or None when no gain is above min_gain.
+    total = class_counts & COUNT_MASK
+    total_entropy = entropy(class_counts)
+    max_information_gain = 0
+    selected = None
+    for attribute_position, attribute_table in enumerate(attribute_tables):
+        if context.attribute_indexes[attribute_position] in (
+                context.numeric_indexes
+        ):
+            information_gain, threshold, counts = _find_best_threshold(
+                attribute_table, total_entropy, class_counts
+            )
+        else:
+            information_gain = calculate_split_information_gain(
+                total_entropy, attribute_table.values(), total
+            )
+            threshold = counts = None
+        if information_gain > max_information_gain:
+            max_information_gain = information_gain
+            selected = (attribute_position, threshold, counts)
+    if max_information_gain <= context.min_gain:
+        return None
+    return selected
+
+
+StreamingContext = namedtuple('StreamingContext', [
+    'headers', 'decision_index', 'attribute_indexes', 'numeric_indexes',
+    'vocabularies', 'max_depth', 'min_samples_split', 'min_gain',
+    'label_increments', 'class_labels',
+])
+
+
+def _split_streaming_node(context, partial_tree, node, attribute_tables,
+                          class_counts, depth):
+    # Returns the leaf label or the node dict, whose children are leaves
+    # already when their counts say so and open nodes otherwise.
+    profiling.count('nodes_built')
+    selected = None
+    if is_open_node(context, class_counts, depth):
+        selected = select_split(context, attribute_tables, class_counts)
+    if selected is None:
+        return get_majority_label(context, class_counts)
+
+    attribute_position, threshold, counts = selected
+    attribute_index = context.attribute_indexes[attribute_position]
+    attribute_table = attribute_tables[attribute_position]
+    header = context.headers[attribute_index]
+    partial_tree.features[node] = attribute_index
+    partial_tree.thresholds[node] = threshold
+    if threshold is not None:
+        branches = zip(
+            get_threshold_keys(header, threshold), [False, True], counts
+        )
+        partial_tree.children[node] = [None, None]
+    else:
+        branches = [
+            (header + SEPARATOR + _get_value_name(
+                context.vocabularies, attribute_index, value
+            ), value, attribute_table[value])
+            for value in attribute_table
+        ]
+        partial_tree.children[node] = {}
+    id3_tree = {}
+    for tree_key, value, child_counts in branches:
+        child = partial_tree.add_node(id3_tree, tree_key)
+        partial_tree.children[node][value] = child
+        if is_open_node(context, child_counts, depth + 1):
+            id3_tree[tree_key] = None
+            partial_tree.open_nodes[child] = (child_counts, depth + 1)
+        else:
+            id3_tree[tree_key] = get_majority_label(context, child_counts)
+    return id3_tree
+
+
+def train_streaming_tree(headers, iter_chunks, decision_index,
+                         attribute_indexes, numeric_indexes=(),
+                         vocabularies=None, max_depth=None,
+                         min_samples_split=2, min_gain=0,
+                         max_open_nodes=None):
+    # Level-wise ID3 for data that does not fit in memory. iter_chunks()
+    # starts a new pass over the data as chunks of columns, and every tree
+    # level costs one pass; memory holds the tree and the count tables of
+    # its open nodes, never the rows. Values are used as they come, or as
+    # codes into vocabularies, and numeric_indexes columns are split on
+    # thresholds. Stopping rules are those of train_columnar_tree, but
+    # ties between majority labels go to the label streamed first. With
+    # max_open_nodes a pass counts at most that many open nodes, oldest
+    # first, so a wide level takes several passes instead of holding the
+    # tables of all its nodes at once.
+    context = StreamingContext(
+        headers, decision_index, attribute_indexes, numeric_indexes,
+        vocabularies, max_depth, min_samples_split, min_gain, {}, []
+    )
+    partial_tree = _PartialTree()
+    root = {}
+    partial_tree.open_nodes[partial_tree.add_node(root, None)] = (None, 0)
+    while partial_tree.open_nodes:
+        counted_nodes = dict(islice(
+            partial_tree.open_nodes.items(), max_open_nodes
+        ))
+        for node in counted_nodes:
+            del partial_tree.open_nodes[node]
+        profiling.count('streaming_passes')
+        with profiling.phase('streaming_pass'):
+            node_tables = _count_pass(
+                context, partial_tree, iter_chunks, counted_nodes
+            )
+        with profiling.phase('split_nodes'):
+            for node, (class_counts, depth) in counted_nodes.items():
+                attribute_tables = node_tables[node]
+                if class_counts is None:
+                    # Only the root is opened before its rows are counted.
+                    class_counts = sum(attribute_tables[0].values()) if (
+                        attribute_tables
+                    ) else 0
+                parent_subtree, tree_key = partial_tree.subtrees[node]
+                parent_subtree[tree_key] = _split_streaming_node(
+                    context, partial_tree, node, attribute_tables,
+                    class_counts, depth
+                )
+    return root.get(None)
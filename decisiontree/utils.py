@@ -1,8 +1,48 @@
+import os
+import tempfile
+
+from array import array
+from contextlib import contextmanager
+
+from decisiontree import profiling
+
+CHUNK_SIZE = 4096
+
+
+@contextmanager
+def replace_file(file_name, mode='wb'):
+    # Writes go to a uniquely named file next to file_name that replaces it
+    # once complete, so readers never see a partial file and concurrent
+    # writers never share a temporary file.
+    descriptor, temporary_file_name = tempfile.mkstemp(
+        suffix='.tmp', prefix=os.path.basename(file_name) + '.',
+        dir=os.path.dirname(os.path.abspath(file_name))
+    )
+    try:
+        # mkstemp files are private, the files they replace are not.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(descriptor, 0o666 & ~umask)
+        with os.fdopen(descriptor, mode) as temporary_file:
+            yield temporary_file
+        os.replace(temporary_file_name, file_name)
+    except BaseException:
+        if os.path.exists(temporary_file_name):
+            os.remove(temporary_file_name)
+        raise
+
+
+def get_source_signature(file_name):
+    # Size and modification time of file_name, stored by the files derived
+    # from it to tell when they are out of date.
+    file_stat = os.stat(file_name)
+    return {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
 
 
 def read_csv_file(file_name):
     lines = []
-    with open(file_name) as csv_file:
+    with profiling.phase('read_csv_file'), open(file_name) as csv_file:
+        profiling.count('bytes_read', os.fstat(csv_file.fileno()).st_size)
         for line in csv_file:
             if line.strip():
                 new_line = []
@@ -12,3 +52,79 @@ def read_csv_file(file_name):
                 if new_line:
                     lines.append(new_line)
     return lines
+
+
+def iter_csv_chunks(file_name, chunk_size=CHUNK_SIZE, exclude_flag=None):
+    chunk = []
+    with open(file_name) as csv_file:
+        profiling.count('bytes_read', os.fstat(csv_file.fileno()).st_size)
+        for line in csv_file:
+            if line.strip():
+                values = [value.strip() for value in line.split(',')]
+                if exclude_flag is not None and exclude_flag in values:
+                    continue
+                chunk.append(values)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_array_typecode(vocabulary_size):
+    if vocabulary_size <= 0xFF:
+        return 'B'
+    if vocabulary_size <= 0xFFFF:
+        return 'H'
+    return 'I'
+
+
+def read_encoded_columns(file_name, column_count=None, vocabularies=None,
+                         chunk_size=CHUNK_SIZE, numeric_indexes=(),
+                         exclude_flag=None):
+    # vocabularies is extended in place, so files read with the same list
+    # share their value codes. Numeric columns get a None vocabulary and
+    # are stored as floats.
+    columns = None
+    value_codes = None
+    for chunk in iter_csv_chunks(file_name, chunk_size, exclude_flag):
+        if columns is None:
+            if column_count is None:
+                column_count = len(chunk[0])
+            if vocabularies is None:
+                vocabularies = []
+            while len(vocabularies) < column_count:
+                vocabularies.append(
+                    None if len(vocabularies) in numeric_indexes else []
+                )
+            value_codes = [
+                None if vocabulary is None else
+                {value: code for code, value in enumerate(vocabulary)}
+                for vocabulary in vocabularies[:column_count]
+            ]
+            columns = [
+                array('d') if vocabulary is None else
+                array(get_array_typecode(len(vocabulary)))
+                for vocabulary in vocabularies[:column_count]
+            ]
+        for column_index, values in enumerate(zip(*chunk)):
+            if column_index == column_count:
+                break
+            codes = value_codes[column_index]
+            if codes is None:
+                columns[column_index].extend(map(float, values))
+                continue
+            vocabulary = vocabularies[column_index]
+            for value in dict.fromkeys(values):
+                if value not in codes:
+                    codes[value] = len(vocabulary)
+                    vocabulary.append(value)
+            column = columns[column_index]
+            typecode = get_array_typecode(len(vocabulary))
+            if typecode != column.typecode:
+                column = columns[column_index] = array(typecode, column)
+            column.extend(map(codes.__getitem__, values))
+    if columns is None:
+        vocabularies = vocabularies if vocabularies is not None else []
+        columns = [array('B') for _ in range(column_count or 0)]
+    return vocabularies, columns
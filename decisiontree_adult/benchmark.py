@@ -0,0 +1,282 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+from decisiontree.columnar import encode_columns
+from decisiontree.id3_algorithm import (calculate_information_gain,
+                                        calculate_total_entropy)
+from decisiontree.utils import read_csv_file, replace_file
+from decisiontree_adult import decision_tree
+from random import Random
+
+ADULT_FILE_NAME = 'adult_new.complete'
+ADULT_HEADERS_FILE_NAME = 'adult_headers.txt'
+SYNTHETIC_DIRECTORY = 'benchmark_data'
+SYNTHETIC_ROWS = [10000, 100000]
+SYNTHETIC_ATTRIBUTES = [10, 100]
+SYNTHETIC_CARDINALITIES = [2, 3, 5, 8, 16, 40, 100, 1000]
+SYNTHETIC_CLASSES = [2]
+SYNTHETIC_NOISE = 0.1
+SEED = 0
+REPEAT = 3
+REGRESSION_TOLERANCE = 0.2
+BENCHMARKS = [
+    'read_csv_file', 'calculate_information_gain', 'train_decision_tree',
+    'calculate_accuracy', 'prune_tree', 'convert_to_if_then',
+]
+
+
+def _get_synthetic_name(rows_count, attributes_count, classes_count):
+    return 'synthetic_{}x{}x{}'.format(
+        rows_count, attributes_count, classes_count
+    )
+
+
+def _get_synthetic_file_names(rows_count, attributes_count, classes_count):
+    name = os.path.join(
+        SYNTHETIC_DIRECTORY,
+        _get_synthetic_name(rows_count, attributes_count, classes_count)
+    )
+    return name + '_headers.txt', name + '.csv'
+
+
+def write_synthetic_dataset(rows_count, attributes_count, classes_count,
+                            seed=SEED):
+    # Attribute cardinalities cycle through SYNTHETIC_CARDINALITIES and the
+    # class depends on the first attributes plus SYNTHETIC_NOISE of random
+    # labels, so the trees have some depth.
+    headers_file_name, data_file_name = _get_synthetic_file_names(
+        rows_count, attributes_count, classes_count
+    )
+    if os.path.exists(data_file_name):
+        return headers_file_name, data_file_name
+    os.makedirs(SYNTHETIC_DIRECTORY, exist_ok=True)
+    with open(headers_file_name, 'w') as headers_file:
+        headers_file.write(', '.join(
+            'a{}'.format(index) for index in range(attributes_count)
+        ) + '\n')
+    cardinalities = [
+        SYNTHETIC_CARDINALITIES[index % len(SYNTHETIC_CARDINALITIES)]
+        for index in range(attributes_count)
+    ]
+    random = Random(seed)
+    with replace_file(data_file_name, 'w') as data_file:
+        for _ in range(rows_count):
+            codes = [random.randrange(cardinality)
+                     for cardinality in cardinalities]
+            label = sum(codes[:3]) % classes_count
+            if random.random() < SYNTHETIC_NOISE:
+                label = random.randrange(classes_count)
+            data_file.write(', '.join(
+                ['v{}'.format(code) for code in codes]
+                + ['c{}'.format(label)]
+            ) + '\n')
+    return headers_file_name, data_file_name
+
+
+def _prepare_benchmark(benchmark, headers, data_file_name):
+    # Everything a benchmark needs besides the timed call is built here.
+    if benchmark == 'read_csv_file':
+        return lambda: read_csv_file(data_file_name)
+    rows = read_csv_file(data_file_name)
+    decision_index = decision_tree.DECISION_INDEX
+    if benchmark == 'calculate_information_gain':
+        total_entropy = calculate_total_entropy(rows, decision_index)
+        return lambda: calculate_information_gain(
+            headers, total_entropy, rows, decision_index
+        )
+    if benchmark == 'train_decision_tree':
+        return lambda: decision_tree.train_decision_tree(headers, rows)
+    id3_tree = decision_tree.train_decision_tree(headers, rows)
+    if benchmark == 'calculate_accuracy':
+        return lambda: decision_tree.calculate_accuracy(
+            id3_tree, rows, headers
+        )
+    if benchmark == 'prune_tree':
+        # Thirds of the rows stand in for validation, training and test.
+        vocabularies, columns = encode_columns(
+            rows, decision_tree.get_column_count(headers)
+        )
+        datasets = [
+            [column[start::3] for column in columns] for start in range(3)
+        ]
+        return lambda: decision_tree.prune_tree(
+            id3_tree, headers, vocabularies, *datasets
+        )
+    return lambda: decision_tree.convert_to_if_then(id3_tree, rows, headers)
+
+
+def _run_benchmark(benchmark, headers, data_file_name, repeat, connection):
+    # Runs in its own process, so peak RSS belongs to this benchmark only.
+    # Like adult_headers.txt, header files only name the attributes and
+    # the decision is the column right after them.
+    decision_tree.DECISION_INDEX = len(headers)
+    result = {}
+    try:
+        function = _prepare_benchmark(benchmark, headers, data_file_name)
+        seconds = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(repeat):
+                started = time.perf_counter()
+                function()
+                elapsed = time.perf_counter() - started
+                if seconds is None or elapsed < seconds:
+                    seconds = elapsed
+        result['seconds'] = seconds
+    except Exception as error:
+        result['error'] = repr(error)
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss
+    connection.send(result)
+    connection.close()
+
+
+def run_benchmark(benchmark, dataset, headers_file_name, data_file_name,
+                  repeat=REPEAT):
+    headers = read_csv_file(headers_file_name)[0]
+    with open(data_file_name) as data_file:
+        rows_count = sum(1 for line in data_file if line.strip())
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_benchmark, args=(
+        benchmark, headers, data_file_name, repeat, sender
+    ))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'exit code {}'.format(process.exitcode)}
+    process.join()
+    result.update({
+        'dataset': dataset,
+        'benchmark': benchmark,
+        'rows': rows_count,
+        'attributes': len(headers),
+    })
+    if result.get('seconds'):
+        result['rows_per_second'] = rows_count / result['seconds']
+    return result
+
+
+def compare_with_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    baseline_seconds = {
+        (result['dataset'], result['benchmark']): result['seconds']
+        for result in baseline['results'] if result.get('seconds')
+    }
+    regressions = 0
+    for result in results:
+        seconds = baseline_seconds.get(
+            (result['dataset'], result['benchmark'])
+        )
+        if seconds is None or not result.get('seconds'):
+            continue
+        result['baseline_seconds'] = seconds
+        result['ratio'] = result['seconds'] / seconds
+        result['regression'] = result['ratio'] > 1 + tolerance
+        regressions += result['regression']
+    return regressions
+
+
+def _get_datasets(arguments):
+    datasets = []
+    for data_file_name in arguments.data:
+        datasets.append((
+            os.path.basename(data_file_name), arguments.headers,
+            data_file_name
+        ))
+    for rows_count in arguments.rows:
+        for attributes_count in arguments.attributes:
+            for classes_count in arguments.classes:
+                headers_file_name, data_file_name = write_synthetic_dataset(
+                    rows_count, attributes_count, classes_count,
+                    arguments.seed
+                )
+                datasets.append((
+                    _get_synthetic_name(
+                        rows_count, attributes_count, classes_count
+                    ),
+                    headers_file_name, data_file_name
+                ))
+    return datasets
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark reading, training, scoring, pruning and '
+                    'if-then export.'
+    )
+    parser.add_argument('--data', nargs='*', default=[ADULT_FILE_NAME])
+    parser.add_argument('--headers', default=ADULT_HEADERS_FILE_NAME)
+    parser.add_argument('--rows', nargs='*', type=int,
+                        default=SYNTHETIC_ROWS)
+    parser.add_argument('--attributes', nargs='*', type=int,
+                        default=SYNTHETIC_ATTRIBUTES)
+    parser.add_argument('--classes', nargs='*', type=int,
+                        default=SYNTHETIC_CLASSES)
+    parser.add_argument('--benchmarks', nargs='*', default=BENCHMARKS,
+                        choices=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--tolerance', type=float,
+                        default=REGRESSION_TOLERANCE)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    arguments = _parse_arguments(argv)
+    results = []
+    for dataset, headers_file_name, data_file_name in _get_datasets(
+            arguments
+    ):
+        for benchmark in arguments.benchmarks:
+            result = run_benchmark(
+                benchmark, dataset, headers_file_name, data_file_name,
+                arguments.repeat
+            )
+            print('{} {}: {}'.format(
+                dataset, benchmark,
+                result.get('seconds', result.get('error'))
+            ), file=sys.stderr)
+            results.append(result)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    regressions = 0
+    if arguments.baseline and not os.path.exists(arguments.baseline):
+        print('No baseline at {}, skipping the comparison (make '
+              'benchmark_baseline saves one)'.format(arguments.baseline),
+              file=sys.stderr)
+    elif arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            regressions = compare_with_baseline(
+                results, json.load(baseline_file), arguments.tolerance
+            )
+        report['regressions'] = regressions
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, 'w') as baseline_file:
+            baseline_file.write(output)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
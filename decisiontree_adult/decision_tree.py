@@ -3,20 +3,78 @@ import multiprocessing
 import json
 import sys
 
-from copy import copy
-from decisiontree.id3_algorithm import (calculate_total_entropy,
-                                        calculate_information_gain)
-from decisiontree.utils import read_csv_file
-from random import randint
+from array import array
+from decisiontree import profiling
+from decisiontree.cache import load_dataset, read_dataset_cache
+from decisiontree.columnar import encode_columns, train_columnar_tree
+from decisiontree.forest import (compile_forest, score_forest_encoded,
+                                 train_forest)
+from decisiontree.incremental import (convert_incremental_to_id3,
+                                      create_incremental_tree,
+                                      read_incremental_checkpoint,
+                                      update_incremental_tree,
+                                      write_incremental_checkpoint)
+from decisiontree.inference import (compile_tree, count_success,
+                                    decompile_tree, route_batch, score,
+                                    score_encoded)
+from decisiontree.model import (convert_json_to_model, convert_model_to_json,
+                                get_numeric_features, read_model,
+                                translate_columns)
+from decisiontree.pruning import (count_encoded_node_decisions,
+                                  prune_compiled_tree)
+from decisiontree.server import serve_predictions
+from decisiontree.splits import (assign_folds, assign_splits,
+                                 get_folds_file_name, get_split_file_name,
+                                 get_split_indexes, read_split_file,
+                                 write_split_file)
+from decisiontree.streaming import (iter_column_chunks,
+                                    iter_csv_column_chunks,
+                                    train_streaming_tree)
+from decisiontree.utils import iter_csv_chunks, read_csv_file, replace_file
 
 TREE_FILE_NAME = 'id3_tree.json'
 TREE_PRUNED_FILE_NAME = 'id3_pruned_tree.json'
+TREE_CONTINUOUS_FILE_NAME = 'id3_continuous_tree.json'
+TREE_MODEL_FILE_NAME = 'id3_tree.model'
+FOREST_FILE_NAME = 'id3_forest.json'
+INCREMENTAL_CHECKPOINT_FILE_NAME = 'id3_tree.checkpoint'
+SERVER_SOCKET_PATH = 'id3_tree.sock'
+PROFILE_OPTION = '--profile'
+LABEL_COLUMN_OPTION = '--label-column'
+SPLIT_OPTION = '--split'
+SPLIT_WORKERS_OPTION = '--split-workers'
+SUBTREE_WORKERS_OPTION = '--subtree-workers'
+PROFILE_SUFFIX = '.profile.json'
+TRACE_SUFFIX = '.trace.json'
 
 SEPARATOR = '__'
 
 DECISION_INDEX = 14
 POSITIVE_DECISION = '>50K'
 NEGATIVE_DECISION = '<=50K'
+# Pruning ties go to the first of these labels that the data has, and then
+# to its other labels in order of first appearance.
+PRUNE_TIE_LABELS = [NEGATIVE_DECISION, POSITIVE_DECISION]
+CONTINUOUS_ATTRIBUTES = [0, 2, 4, 10, 11, 12]
+UNKNOWN_FLAG = '?'
+MAX_DEPTH = None
+MIN_SAMPLES_SPLIT = 2
+MIN_GAIN = 0
+SPLIT_WORKERS = 1
+PARALLEL_SPLIT_ROWS = 10000
+SUBTREE_WORKERS = 1
+PARALLEL_SUBTREE_ROWS = 1000
+STREAMING_OPEN_NODES = 1024
+FOREST_SIZE = 100
+FOREST_MAX_FEATURES = None
+FOREST_WORKERS = multiprocessing.cpu_count()
+SPLIT_NAMES = ['training', 'validation', 'test']
+SPLIT_FRACTIONS = [0.7, 0.15, 0.15]
+USE_SPLIT = False
+# Actions that never load the data columns, so they cannot use --split.
+UNLOADED_ACTIONS = ['model', 'model-json', 'serve', 'training-streaming',
+                    'training-streaming-continuous', 'training-incremental']
+ROW_ACTIONS = ['ifthen', 'ifthen-prune']
 TABS_PER_LINE = 4
 IFTHEN_FILE_PATH = 'ifthen.txt'
 IFTHEN_PRUNE_FILE_PATH = 'ifthen-prune.txt'
@@ -25,84 +83,98 @@ WORKER = multiprocessing.cpu_count() * 2
 global id3_tree_global
 global headers_data
 
-
-def _get_attribute_with_max_information_gain(
-        attributtes_information_gain_dict
-):
-    max_information_gain = 0
-    attribute_with_max_information_gain = None
-    for attribute, information_gain in attributtes_information_gain_dict.items():  # noqa
-        if information_gain > max_information_gain:
-            max_information_gain = information_gain
-            attribute_with_max_information_gain = attribute
-    return attribute_with_max_information_gain, max_information_gain
+validation_data = None
 
 
-def _update_id3_tree_with_attribute(
-        attribute_variations, selected_attribute, id3_tree
-):
-    for variation in attribute_variations:
-        id3_tree_key = _get_id3_tree_key(selected_attribute, variation)
-        id3_tree[id3_tree_key] = {}
-    return id3_tree
+def get_column_count(headers):
+    # Headers name the columns in order; the label column only needs a
+    # header when attributes come after it.
+    return max(len(headers), DECISION_INDEX + 1)
 
 
-def _get_attribute_variations(attribute_index, lines):
-    attribute_variations = set(
-        [variation[attribute_index] for variation in lines]
+def train_encoded_decision_tree(attributes, vocabularies, columns,
+                                indexes=None, split_workers=None,
+                                subtree_workers=None):
+    # Worker counts default to the module settings at call time, which the
+    # command line options may have changed.
+    if split_workers is None:
+        split_workers = SPLIT_WORKERS
+    if subtree_workers is None:
+        subtree_workers = SUBTREE_WORKERS
+    return train_columnar_tree(
+        attributes, vocabularies, columns, DECISION_INDEX, indexes,
+        MAX_DEPTH, MIN_SAMPLES_SPLIT, MIN_GAIN, split_workers,
+        PARALLEL_SPLIT_ROWS, subtree_workers, PARALLEL_SUBTREE_ROWS
     )
-    return attribute_variations
 
 
-def _get_id3_tree_key(selected_attribute, variation):
-    id3_tree_key = selected_attribute + SEPARATOR + variation
-    return id3_tree_key
-
-
-def train_decision_tree(attributes, lines, entropy, id3_tree={}):
-    attributtes_information_gain_dict = calculate_information_gain(
-        attributes, entropy, lines, POSITIVE_DECISION, DECISION_INDEX
+def train_streaming_decision_tree(attributes, input_file_data,
+                                  numeric_indexes=(), exclude_flag=None):
+    # One pass over the data per tree level, reading the columns of a valid
+    # binary cache when there is one and the CSV file otherwise; the data
+    # is never loaded as a whole.
+    attribute_indexes = [
+        column_index for column_index in range(get_column_count(attributes))
+        if column_index != DECISION_INDEX
+    ]
+    dataset = read_dataset_cache(
+        input_file_data, numeric_indexes=numeric_indexes,
+        exclude_flag=exclude_flag
     )
-    selected_attribute, max_information_gain = _get_attribute_with_max_information_gain(
-        attributtes_information_gain_dict
+    if dataset is None:
+        vocabularies = None
+
+        def iter_chunks():
+            return iter_csv_column_chunks(
+                input_file_data, numeric_indexes, exclude_flag
+            )
+    else:
+        vocabularies, columns = dataset
+
+        def iter_chunks():
+            return iter_column_chunks(columns)
+    return train_streaming_tree(
+        attributes, iter_chunks, DECISION_INDEX, attribute_indexes,
+        numeric_indexes, vocabularies, MAX_DEPTH, MIN_SAMPLES_SPLIT, MIN_GAIN,
+        STREAMING_OPEN_NODES
     )
 
-    if not selected_attribute:
-        return lines[0][DECISION_INDEX]
 
-    attribute_index = attributes.index(selected_attribute)
-    attribute_variations = _get_attribute_variations(attribute_index, lines)
-    id3_tree = _update_id3_tree_with_attribute(
-        attribute_variations, selected_attribute, id3_tree
+def train_incremental_decision_tree(attributes, input_file_data):
+    # Adds the rows of input_file_data to the tree of the checkpoint, or to
+    # a new tree when there is none, one chunk at a time, and saves the
+    # checkpoint for the next rows.
+    incremental_tree = read_incremental_checkpoint(
+        INCREMENTAL_CHECKPOINT_FILE_NAME
     )
-    variations_lines_dict = _create_variation_dict(attribute_variations)
-    while len(lines):
-        line = lines.pop()
-        variations_lines_dict[line[attribute_index]].append(line)
-    for attribute_variation, variations_lines in variations_lines_dict.items():
-        variation_entropy = calculate_total_entropy(
-            variations_lines, POSITIVE_DECISION,
-            NEGATIVE_DECISION, DECISION_INDEX
-        )
-        id3_tree_key = _get_id3_tree_key(
-            selected_attribute, attribute_variation
+    if incremental_tree is None:
+        incremental_tree = create_incremental_tree(
+            attributes, DECISION_INDEX, [
+                column_index
+                for column_index in range(get_column_count(attributes))
+                if column_index != DECISION_INDEX
+            ], max_depth=MAX_DEPTH, min_samples_split=MIN_SAMPLES_SPLIT,
+            min_gain=MIN_GAIN
         )
-        id3_tree[id3_tree_key] = train_decision_tree(
-            attributes, variations_lines,
-            variation_entropy, id3_tree[id3_tree_key]
-        )
-    return id3_tree
+    with profiling.phase('update_incremental_tree'):
+        for chunk in iter_csv_chunks(input_file_data):
+            update_incremental_tree(incremental_tree, chunk)
+    write_incremental_checkpoint(
+        incremental_tree, INCREMENTAL_CHECKPOINT_FILE_NAME
+    )
+    return convert_incremental_to_id3(incremental_tree)
 
 
-def _create_variation_dict(attribute_variations):
-    attribute_variations_dict = {}
-    for attribute_variation in attribute_variations:
-        attribute_variations_dict[attribute_variation] = []
-    return attribute_variations_dict
+def train_decision_tree(attributes, lines):
+    vocabularies, columns = encode_columns(
+        lines, get_column_count(attributes)
+    )
+    return train_encoded_decision_tree(attributes, vocabularies, columns)
 
 
 def save_json_to_file(id3_tree, file_path):
-    with open(file_path, 'w') as id3_file_path:
+    # Replaced atomically so a serving process never reads half a tree.
+    with replace_file(file_path, 'w') as id3_file_path:
         id3_file_path.write(json.dumps(id3_tree))
 
 
@@ -116,264 +188,509 @@ def read_id3_tree_pruned():
         return json.loads(id3_file.read())
 
 
-def get_decision_attribute(id3_tree):
-    return list(id3_tree.keys())[0].split(SEPARATOR)[0]
+def read_forest():
+    with open(FOREST_FILE_NAME, 'r') as forest_file:
+        return json.loads(forest_file.read())
 
 
-id3_key_regexes = {}
+def read_id3_tree_continuous():
+    with open(TREE_CONTINUOUS_FILE_NAME, 'r') as id3_file:
+        return json.loads(id3_file.read())
 
 
-def get_id3_key(id3_tree, decision_attribute, decision_attribute_value):
-    key = decision_attribute + SEPARATOR + decision_attribute_value
-    keys_list = list(id3_tree.keys())
-    if key in keys_list:
-        return key
+def get_unflagged_indexes(vocabularies, columns, indexes, exclude_flag):
+    # Continuous data is loaded with all its rows, so split indexes point at
+    # the right rows, and the rows with an exclude_flag value are left out
+    # here instead.
+    if indexes is None:
+        indexes = range(len(columns[DECISION_INDEX]))
+    flag_codes = [
+        (column, vocabulary.index(exclude_flag))
+        for vocabulary, column in zip(vocabularies, columns)
+        if vocabulary is not None and exclude_flag in vocabulary
+    ]
+    return array('I', [
+        index for index in indexes
+        if all(column[index] != flag_code for column, flag_code in flag_codes)
+    ])
+
+
+def separate_folds(label_column, fold_number, seed=None,
+                   folds_file_name=None, source_file_name=None):
+    # Seeded folds are kept in folds_file_name, so later runs with the same
+    # seed and fold number read them back while source_file_name, the file
+    # the rows come from, is unchanged.
+    options = {'fold_number': fold_number, 'seed': seed}
+    persist = folds_file_name is not None and seed is not None
+    folds = None
+    if persist:
+        folds = read_split_file(
+            folds_file_name, len(label_column), options, source_file_name
+        )
+    if folds is None:
+        assignments = assign_folds(label_column, fold_number, seed)
+        if persist:
+            write_split_file(
+                folds_file_name, assignments,
+                [str(fold_index) for fold_index in range(fold_number)],
+                options, source_file_name
+            )
     else:
-        #print('Key not found for {} and {}'.format(
-        #    decision_attribute, decision_attribute_value
-        #))
-        return None
-
-
-def test_data(id3_tree, headers, data):
-    if isinstance(id3_tree, str):
-        return data[DECISION_INDEX] == id3_tree
-    decision_attribute = get_decision_attribute(id3_tree)
-    decision_attribute_index = headers.index(decision_attribute)
-    decision_attribute_value = data[decision_attribute_index]
-
-    id3_key = get_id3_key(
-        id3_tree, decision_attribute,
-        decision_attribute_value
+        _, assignments = folds
+    return get_split_indexes(assignments, fold_number)
+
+
+def split_dataset(input_file_data, label_column, seed=None):
+    assignments = assign_splits(label_column, SPLIT_FRACTIONS, seed)
+    write_split_file(
+        get_split_file_name(input_file_data), assignments, SPLIT_NAMES,
+        {'fractions': SPLIT_FRACTIONS, 'seed': seed}, input_file_data
     )
-    if id3_key is None:
-        return False
-    return test_data(id3_tree[id3_key], headers, data)
+    return get_split_indexes(assignments, len(SPLIT_NAMES))
 
 
-def separate_folds(file_data, fold_number):
-    folds = [[] for x in range(fold_number)]
-    count = 0
-    while len(file_data) > 0:
-        i = randint(0, (len(file_data) - 1))
-        folds[count].append(file_data.pop(i))
-        count += 1
-        if count > (fold_number - 1):
-            count = 0
-    return folds
+def read_split_indexes(input_file_data, label_column):
+    split = read_split_file(
+        get_split_file_name(input_file_data), len(label_column),
+        source_file_name=input_file_data
+    )
+    if split is None:
+        raise ValueError('{} has no split for its current {} lines, run the '
+                         'split action first'.format(input_file_data,
+                                                     len(label_column)))
+    names, assignments = split
+    return dict(zip(names, get_split_indexes(assignments, len(names))))
+
+
+def _validate_fold(fold_index):
+    headers, vocabularies, columns, folds = validation_data
+    training_fold = array('I')
+    for i, fold in enumerate(folds):
+        if i != fold_index:
+            training_fold.extend(fold)
+    # Pool workers are daemonic and cannot start pools of their own.
+    id3_tree = train_encoded_decision_tree(
+        headers, vocabularies, columns, training_fold, 1, 1
+    )
+    _, confusion_matrix, _ = score_encoded(
+        compile_tree(id3_tree, headers, vocabularies), vocabularies,
+        columns, DECISION_INDEX, folds[fold_index]
+    )
+    success = count_success(confusion_matrix)
+    return success, len(folds[fold_index]) - success, count_nodes(id3_tree)
+
+
+def cross_validate(headers, vocabularies, columns, fold_number, seed=None,
+                   folds_file_name=None, indexes=None, source_file_name=None):
+    global validation_data
+    label_column = columns[DECISION_INDEX]
+    if indexes is not None:
+        label_column = list(map(label_column.__getitem__, indexes))
+    folds = separate_folds(
+        label_column, fold_number, seed, folds_file_name, source_file_name
+    )
+    if indexes is not None:
+        folds = [array('I', map(indexes.__getitem__, fold)) for fold in folds]
+    # Workers are forked after validation_data is set, so they read the
+    # encoded columns from the parent's pages instead of pickled copies.
+    validation_data = (headers, vocabularies, columns, folds)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(WORKER, fold_number)) as pool:
+        return pool.map(_validate_fold, range(fold_number))
 
 
 def calculate_accuracy(id3_tree, file_data, headers):
-    success = 0
-    errors = 0
-    for line in file_data:
-        tested_data = test_data(id3_tree, headers, line)
-        if tested_data:
-            success += 1
-        else:
-            errors += 1
-    return success / (success + errors)
+    _, _, accuracy = score(
+        compile_tree(id3_tree, headers), file_data, DECISION_INDEX
+    )
+    return accuracy
 
 
 def count_nodes(id3_tree):
     keys = 0
-    keys += len(id3_tree.keys())
-    for key in id3_tree.keys():
-        if isinstance(id3_tree[key], dict):
-            keys += count_nodes(id3_tree[key])
+    subtrees = [id3_tree]
+    while subtrees:
+        subtree = subtrees.pop()
+        keys += len(subtree)
+        for value in subtree.values():
+            if isinstance(value, dict):
+                subtrees.append(value)
     return keys
 
 
-def prune_tree(id3_tree, id3_tree_part, file_data_validation, headers, file_data_training, file_data_test):
-    for key, value in id3_tree_part.items():
-        if value not in [NEGATIVE_DECISION, POSITIVE_DECISION]:
-            old_accuracy = calculate_accuracy(
-                id3_tree, file_data_validation, headers
-            )
-            branch_aux = copy(value)
+def _print_prune_progress(accuracies, size):
+    accuracy_validation, accuracy_training, accuracy_test = accuracies
+    print('accuracy train: {} - accuracy validation: {} - accuracy test {} - size {} nodes'
+          .format(accuracy_training, accuracy_validation, accuracy_test, size))
 
-            id3_tree_part[key] = POSITIVE_DECISION
-            positive_accuracy = calculate_accuracy(
-                id3_tree, file_data_validation, headers
-            )
 
-            id3_tree_part[key] = NEGATIVE_DECISION
-            negative_accuracy = calculate_accuracy(
-                id3_tree, file_data_validation, headers
-            )
+def get_prune_labels(decision_vocabulary):
+    prune_labels = [
+        label for label in PRUNE_TIE_LABELS if label in decision_vocabulary
+    ]
+    return prune_labels + [
+        label for label in decision_vocabulary if label not in prune_labels
+    ]
 
-            if (old_accuracy >= negative_accuracy
-               and old_accuracy >= positive_accuracy):
-                id3_tree_part[key] = branch_aux
-
-            else:
-                new_accuracy_training = calculate_accuracy(
-                    id3_tree, file_data_training, headers
-                )
-                new_accuracy_test = calculate_accuracy(
-                    id3_tree, file_data_test, headers
-                )
-                print('accuracy train: {} - accuracy validation: {} - accuracy test {} - size {} nodes'
-                      .format(
-                        new_accuracy_training, max(
-                            positive_accuracy, negative_accuracy
-                        ), new_accuracy_test, count_nodes(id3_tree)
-                       ))
-
-                if positive_accuracy > negative_accuracy:
-                    id3_tree_part[key] = POSITIVE_DECISION
-                else:
-                    id3_tree_part[key] = NEGATIVE_DECISION
-
-            prune_tree(id3_tree, value, file_data_validation, headers, file_data_training, file_data_test)
-    return id3_tree
-
-
-def _get_key_with_most_accuracy(accuracy_dict):
-    max_accuracy = None
-    max_accuracy_key = None
-    for tree_key, tree_accuracy in accuracy_dict.items():
-        if max_accuracy is None or tree_accuracy > max_accuracy:
-            max_accuracy = tree_accuracy
-            max_accuracy_key = tree_key
-    return max_accuracy_key
+
+def prune_tree(id3_tree, headers, vocabularies, columns_validation,
+               columns_training, columns_test, datasets_indexes=None):
+    compiled_tree = compile_tree(id3_tree, headers, vocabularies)
+    if datasets_indexes is None:
+        datasets_indexes = [None, None, None]
+    datasets_node_counts = [
+        count_encoded_node_decisions(
+            compiled_tree, vocabularies, columns, DECISION_INDEX, indexes
+        )
+        for columns, indexes in zip(
+            [columns_validation, columns_training, columns_test],
+            datasets_indexes
+        )
+    ]
+    pruned_tree = prune_compiled_tree(
+        compiled_tree, datasets_node_counts,
+        get_prune_labels(vocabularies[DECISION_INDEX]), _print_prune_progress
+    )
+    return decompile_tree(pruned_tree, vocabularies)
 
 
 def _create_if_then_tree_key(tree_key, then_nodes=False):
     if then_nodes:
         return 'THEN {}\n'.format(tree_key)
-    return 'IF {} == {}\n'.format(*tree_key.split(SEPARATOR))
-
-
-def _get_lines_that_match_key(headers, tree_key, file_data):
-    key, value = tree_key.split(SEPARATOR)
-    attribute_index = headers.index(key)
-    subtree_data = []
-    for line in file_data:
-        if line[attribute_index] == value:
-            subtree_data.append(line)
-    return subtree_data
+    key_parts = tree_key.split(SEPARATOR)
+    if len(key_parts) == 3:
+        return 'IF {} {} {}\n'.format(*key_parts)
+    return 'IF {} == {}\n'.format(*key_parts)
+
+
+def _get_branch_accuracies(id3_tree, file_data, headers):
+    # Nodes are numbered breadth first in key order like compile_tree does,
+    # so the data is routed through the tree once and every node gets the
+    # accuracy of its subtree on the lines that reach it.
+    nodes = [id3_tree]
+    first_children = []
+    for node in nodes:
+        first_children.append(len(nodes))
+        if isinstance(node, dict):
+            nodes.extend(node.values())
+    compiled_tree = compile_tree(id3_tree, headers)
+    reached = [0] * len(nodes)
+    correct = [0] * len(nodes)
+    for node, positions in route_batch(compiled_tree, file_data):
+        reached[node] = len(positions)
+        if isinstance(nodes[node], str):
+            correct[node] = sum(
+                1 for position in positions
+                if file_data[position][DECISION_INDEX] == nodes[node]
+            )
+    for node in range(len(nodes) - 1, -1, -1):
+        if isinstance(nodes[node], dict):
+            correct[node] = sum(correct[
+                first_children[node]:first_children[node] + len(nodes[node])
+            ])
+    accuracies = [
+        node_correct / node_reached if node_reached else 0
+        for node_correct, node_reached in zip(correct, reached)
+    ]
+    return first_children, accuracies
+
+
+def iterate_if_then(id3_tree, file_data, headers, tabs_prefix=0):
+    first_children, accuracies = _get_branch_accuracies(
+        id3_tree, file_data, headers
+    )
+    pending = [(id3_tree, 0, tabs_prefix)]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            yield item
+            continue
+        id3_subtree, node, tabs = item
+        tabs_before = ' ' * TABS_PER_LINE * tabs
+        if isinstance(id3_subtree, str):
+            yield tabs_before + _create_if_then_tree_key(
+                id3_subtree, then_nodes=True
+            )
+            continue
+        # Most accurate branches first, ties in key order.
+        children = sorted(
+            enumerate(id3_subtree.items(), first_children[node]),
+            key=lambda child: -accuracies[child[0]]
+        )
+        branches = []
+        for child, (tree_key, child_subtree) in children:
+            branches.append(tabs_before + _create_if_then_tree_key(tree_key))
+            branches.append((child_subtree, child, tabs + 1))
+        pending.extend(reversed(branches))
 
 
 def convert_to_if_then(id3_tree, file_data, headers, tabs_prefix=0):
-    tabs_before = ' ' * TABS_PER_LINE * tabs_prefix
-    if isinstance(id3_tree, str):
-        return (tabs_before
-                + _create_if_then_tree_key(id3_tree, then_nodes=True))
-    if_then = ''
-    keys_list = list(id3_tree.keys())
-    accuracy_dict = {}
-    for key in keys_list:
-        accuracy = calculate_accuracy(id3_tree[key], file_data, headers)
-        accuracy_dict[key] = accuracy
-    while accuracy_dict:
-        tree_key = _get_key_with_most_accuracy(accuracy_dict)
-        del accuracy_dict[tree_key]
-        if_then += tabs_before + _create_if_then_tree_key(tree_key)
-        subtree_data = _get_lines_that_match_key(headers, tree_key, file_data)
-        subif = convert_to_if_then(
-            id3_tree[tree_key], subtree_data,
-            headers, tabs_prefix=tabs_prefix + 1
-        )
-        if_then += subif
-    return if_then
+    return ''.join(iterate_if_then(id3_tree, file_data, headers, tabs_prefix))
 
 
 def save_ifthen_to_file(ifthen, path):
+    # Lines are written as they are produced, so the text is never held
+    # in memory.
     with open(path, 'w') as ifthen_file_path:
-        ifthen_file_path.write(ifthen)
+        ifthen_file_path.writelines(ifthen)
 
 
-def print_accuracy(id3_tree, headers, file_data):
-    success = 0
-    errors = 0
-    for line in file_data:
-        tested_data = test_data(id3_tree, headers, line)
-        if tested_data:
-            success += 1
-        else:
-            errors += 1
+def print_accuracy(id3_tree, headers, vocabularies, columns, indexes=None):
+    if indexes is None:
+        indexes = range(len(columns[DECISION_INDEX]))
+    lines_count = len(indexes)
+    _, confusion_matrix, accuracy = score_encoded(
+        compile_tree(id3_tree, headers, vocabularies), vocabularies, columns,
+        DECISION_INDEX, indexes
+    )
+    success = count_success(confusion_matrix)
     print('Total {} Sucessos {} Erros {} Accuracy {} Size {} nodes'.format(
-        success+errors, success, errors,
-        calculate_accuracy(id3_tree, file_data, headers),
+        lines_count, success, lines_count - success, accuracy,
         count_nodes(id3_tree)
     ))
 
 
+def print_forest_accuracy(forest, headers, vocabularies, columns,
+                          indexes=None):
+    if indexes is None:
+        indexes = range(len(columns[DECISION_INDEX]))
+    lines_count = len(indexes)
+    _, confusion_matrix, accuracy = score_forest_encoded(
+        compile_forest(forest, headers, vocabularies), vocabularies, columns,
+        DECISION_INDEX, indexes
+    )
+    success = count_success(confusion_matrix)
+    print('Total {} Sucessos {} Erros {} Accuracy {} Size {} trees {} nodes'
+          .format(lines_count, success, lines_count - success, accuracy,
+                  len(forest), sum(map(count_nodes, forest))))
+
+
+def print_model_accuracy(model, vocabularies, columns, indexes=None):
+    if indexes is None:
+        indexes = range(len(columns[DECISION_INDEX]))
+    lines_count = len(indexes)
+    _, confusion_matrix, accuracy = score_encoded(
+        model.compiled_tree, vocabularies,
+        translate_columns(model, vocabularies, columns), DECISION_INDEX,
+        indexes
+    )
+    success = count_success(confusion_matrix)
+    print('Total {} Sucessos {} Erros {} Accuracy {} Size {} nodes'.format(
+        lines_count, success, lines_count - success, accuracy,
+        len(model.compiled_tree.features) - 1
+    ))
+
+
 def run(
     action, input_file_headers, input_file_data,
-    fold_number, input_file_test, input_file_validation
+    fold_number, input_file_test, input_file_validation, seed=None
 ):
+    if USE_SPLIT and action in UNLOADED_ACTIONS + ROW_ACTIONS:
+        raise ValueError('the {} action does not support {}'.format(
+            action, SPLIT_OPTION
+        ))
     headers = read_csv_file(input_file_headers)[0]
-    file_data = read_csv_file(input_file_data)
-    if action == 'training':
-        total_entropy_adult = calculate_total_entropy(
-            file_data, POSITIVE_DECISION, NEGATIVE_DECISION,
-            DECISION_INDEX
+    column_count = get_column_count(headers)
+    with profiling.phase('load'):
+        if action in UNLOADED_ACTIONS:
+            pass
+        elif action in ROW_ACTIONS:
+            file_data = read_csv_file(input_file_data)
+        elif action in ['training-continuous', 'test-continuous']:
+            vocabularies, columns = load_dataset(
+                input_file_data, column_count,
+                numeric_indexes=CONTINUOUS_ATTRIBUTES
+            )
+        elif action == 'test-model':
+            # Threshold nodes compare values, so their columns are read as
+            # numbers.
+            model = read_model(TREE_MODEL_FILE_NAME)
+            numeric_indexes = get_numeric_features(model)
+            vocabularies, columns = load_dataset(
+                input_file_data, column_count,
+                numeric_indexes=numeric_indexes
+            )
+        else:
+            vocabularies, columns = load_dataset(
+                input_file_data, column_count
+            )
+
+    # With --split the actions work on the rows of one data file that the
+    # split action assigned to them, so no copies of the data are written.
+    split_indexes = dict.fromkeys(SPLIT_NAMES)
+    folds_file_name = get_folds_file_name(input_file_data)
+    folds_source_file_name = input_file_data
+    if USE_SPLIT:
+        split_indexes = read_split_indexes(
+            input_file_data, columns[DECISION_INDEX]
         )
-        id3_tree = train_decision_tree(
-            headers, file_data, total_entropy_adult
+        # The folds of the training split go stale when it is split again.
+        folds_source_file_name = get_split_file_name(input_file_data)
+        folds_file_name = get_folds_file_name(folds_source_file_name)
+
+    if action == 'split':
+        for name, indexes in zip(SPLIT_NAMES, split_dataset(
+                input_file_data, columns[DECISION_INDEX], seed
+        )):
+            print('{} {} lines'.format(name, len(indexes)))
+
+    if action == 'training':
+        id3_tree = train_encoded_decision_tree(
+            headers, vocabularies, columns, split_indexes['training']
         )
         save_json_to_file(id3_tree, TREE_FILE_NAME)
 
-    if action == 'test':
-        id3_tree = read_id3_tree()
-        print_accuracy(id3_tree, headers, file_data)
+    if action == 'training-streaming':
+        id3_tree = train_streaming_decision_tree(headers, input_file_data)
+        save_json_to_file(id3_tree, TREE_FILE_NAME)
 
-    if action == 'test_prune':
-        id3_tree = read_id3_tree_pruned()
-        print_accuracy(id3_tree, headers, file_data)
+    if action == 'training-streaming-continuous':
+        id3_tree = train_streaming_decision_tree(
+            headers, input_file_data, CONTINUOUS_ATTRIBUTES, UNKNOWN_FLAG
+        )
+        save_json_to_file(id3_tree, TREE_CONTINUOUS_FILE_NAME)
 
-    if action == 'validation':
-        folds = separate_folds(file_data, fold_number)
-        for i in range(fold_number):
-            fold_aux = folds.pop(i)
+    if action == 'training-incremental':
+        id3_tree = train_incremental_decision_tree(headers, input_file_data)
+        save_json_to_file(id3_tree, TREE_FILE_NAME)
 
-            training_fold = []
+    if action == 'training-forest':
+        forest, out_of_bag_accuracy = train_forest(
+            headers, vocabularies, columns, DECISION_INDEX,
+            split_indexes['training'], FOREST_SIZE, FOREST_MAX_FEATURES,
+            seed, FOREST_WORKERS, MAX_DEPTH, MIN_SAMPLES_SPLIT, MIN_GAIN
+        )
+        save_json_to_file(forest, FOREST_FILE_NAME)
+        print('Out-of-bag accuracy {} Size {} trees {} nodes'.format(
+            out_of_bag_accuracy, len(forest), sum(map(count_nodes, forest))
+        ))
+
+    if action == 'test-forest':
+        forest = read_forest()
+        print_forest_accuracy(
+            forest, headers, vocabularies, columns, split_indexes['test']
+        )
 
-            for j in folds:
-                training_fold = training_fold + j
+    if action == 'training-continuous':
+        id3_tree = train_encoded_decision_tree(
+            headers, vocabularies, columns, get_unflagged_indexes(
+                vocabularies, columns, split_indexes['training'],
+                UNKNOWN_FLAG
+            )
+        )
+        save_json_to_file(id3_tree, TREE_CONTINUOUS_FILE_NAME)
 
-            total_entropy_adult = calculate_total_entropy(
-                training_fold, POSITIVE_DECISION, NEGATIVE_DECISION,
-                DECISION_INDEX
+    if action == 'test-continuous':
+        id3_tree = read_id3_tree_continuous()
+        print_accuracy(
+            id3_tree, headers, vocabularies, columns, get_unflagged_indexes(
+                vocabularies, columns, split_indexes['test'], UNKNOWN_FLAG
             )
-            id3_tree = train_decision_tree(
-                headers, training_fold, total_entropy_adult
+        )
+
+    if action == 'model':
+        convert_json_to_model(TREE_FILE_NAME, TREE_MODEL_FILE_NAME, headers)
+
+    if action == 'model-json':
+        convert_model_to_json(TREE_MODEL_FILE_NAME, TREE_FILE_NAME)
+
+    if action == 'test-model':
+        indexes = split_indexes['test']
+        if numeric_indexes:
+            # Threshold trees come from the continuous actions, which leave
+            # out the rows with unknown values.
+            indexes = get_unflagged_indexes(
+                vocabularies, columns, indexes, UNKNOWN_FLAG
             )
-            print_accuracy(id3_tree, headers, fold_aux)
+        print_model_accuracy(model, vocabularies, columns, indexes)
+
+    if action == 'serve':
+        print(json.dumps(serve_predictions(
+            TREE_FILE_NAME, headers, SERVER_SOCKET_PATH
+        )))
+
+    if action == 'test':
+        id3_tree = read_id3_tree()
+        print_accuracy(
+            id3_tree, headers, vocabularies, columns, split_indexes['test']
+        )
+
+    if action == 'test_prune':
+        id3_tree = read_id3_tree_pruned()
+        print_accuracy(
+            id3_tree, headers, vocabularies, columns, split_indexes['test']
+        )
 
-            folds.insert(i, fold_aux)
+    if action == 'validation':
+        folds_result = cross_validate(
+            headers, vocabularies, columns, fold_number, seed,
+            folds_file_name, split_indexes['training'], folds_source_file_name
+        )
+        for success, errors, nodes in folds_result:
+            print('Total {} Sucessos {} Erros {} Accuracy {} Size {} nodes'
+                  .format(success + errors, success, errors,
+                          success / (success + errors), nodes))
 
     if action == 'ifthen':
         id3_tree = read_id3_tree()
-        ifthen = convert_to_if_then(id3_tree, file_data, headers)
+        ifthen = iterate_if_then(id3_tree, file_data, headers)
         save_ifthen_to_file(ifthen, IFTHEN_FILE_PATH)
 
     if action == 'ifthen-prune':
         id3_tree = read_id3_tree_pruned()
-        ifthen = convert_to_if_then(id3_tree, file_data, headers)
+        ifthen = iterate_if_then(id3_tree, file_data, headers)
         save_ifthen_to_file(ifthen, IFTHEN_PRUNE_FILE_PATH)
 
-    if action == 'prune':
-        total_entropy_adult = calculate_total_entropy(
-            file_data, POSITIVE_DECISION, NEGATIVE_DECISION,
-            DECISION_INDEX
+    if action == 'prune' and USE_SPLIT:
+        id3_tree = train_encoded_decision_tree(
+            headers, vocabularies, columns, split_indexes['training']
+        )
+        id3_pruned_tree = prune_tree(
+            id3_tree, headers, vocabularies, columns, columns, columns,
+            [split_indexes['validation'], split_indexes['training'],
+             split_indexes['test']]
         )
-        id3_tree = train_decision_tree(
-            headers, file_data, total_entropy_adult
+        save_json_to_file(id3_pruned_tree, TREE_PRUNED_FILE_NAME)
+
+    elif action == 'prune':
+        id3_tree = train_encoded_decision_tree(
+            headers, vocabularies, columns
+        )
+        _, columns_test = load_dataset(
+            input_file_test, column_count, vocabularies
+        )
+        _, columns_validation = load_dataset(
+            input_file_validation, column_count, vocabularies
         )
-        file_data = read_csv_file(input_file_data)
-        file_data_test = read_csv_file(input_file_test)
-        file_data_validation = read_csv_file(input_file_validation)
         id3_pruned_tree = prune_tree(
-            id3_tree, id3_tree, file_data_test, headers, file_data,
-            file_data_validation
+            id3_tree, headers, vocabularies, columns_test, columns,
+            columns_validation
         )
         save_json_to_file(id3_pruned_tree, TREE_PRUNED_FILE_NAME)
 
 
+def _pop_int_option(option, default):
+    if option not in sys.argv:
+        return default
+    option_index = sys.argv.index(option)
+    value = int(sys.argv[option_index + 1])
+    del sys.argv[option_index:option_index + 2]
+    return value
+
+
 if __name__ == '__main__':
+    profile = PROFILE_OPTION in sys.argv
+    if profile:
+        sys.argv.remove(PROFILE_OPTION)
+        profiling.enable()
+    DECISION_INDEX = _pop_int_option(LABEL_COLUMN_OPTION, DECISION_INDEX)
+    SPLIT_WORKERS = _pop_int_option(SPLIT_WORKERS_OPTION, SPLIT_WORKERS)
+    SUBTREE_WORKERS = _pop_int_option(
+        SUBTREE_WORKERS_OPTION, SUBTREE_WORKERS
+    )
+    if SPLIT_OPTION in sys.argv:
+        sys.argv.remove(SPLIT_OPTION)
+        USE_SPLIT = True
     if not len(sys.argv) > 2:
         print('Please provide the headers and data file path.')
     input_file_headers_param = sys.argv[1]
@@ -382,6 +699,13 @@ if __name__ == '__main__':
     input_file_test = sys.argv[5]
     input_file_validation = sys.argv[6]
     action = sys.argv[3]
-    run(action, input_file_headers_param,
-        input_file_data_param, fold_number,
-        input_file_test, input_file_validation)
+    seed = int(sys.argv[7]) if len(sys.argv) > 7 else None
+    with profiling.phase(action):
+        run(action, input_file_headers_param,
+            input_file_data_param, fold_number,
+            input_file_test, input_file_validation, seed)
+    if profile:
+        # Pool workers are not instrumented, only this process is.
+        print(profiling.format_summary(), file=sys.stderr)
+        profiling.write_summary(action + PROFILE_SUFFIX)
+        profiling.write_chrome_trace(action + TRACE_SUFFIX)
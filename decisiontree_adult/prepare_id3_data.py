@@ -1,7 +1,11 @@
 import sys
 import re
 
-from decisiontree.utils import read_csv_file
+from array import array
+from bisect import bisect_left
+from decisiontree.cache import write_dataset_cache
+from decisiontree.utils import iter_csv_chunks, read_encoded_columns
+from random import randrange
 
 DIGIT_REGEX = '^\d+'
 digit_regex_compiled = re.compile(DIGIT_REGEX)
@@ -14,41 +18,84 @@ def _has_exclude_flag(line, exclude_flag):
     return False
 
 
+def _iter_lines(input_file_path):
+    for chunk in iter_csv_chunks(input_file_path):
+        yield from chunk
+
+
+def _format_cut_point(cut_point):
+    if cut_point.is_integer():
+        return str(int(cut_point))
+    return repr(cut_point)
+
+
+def _create_bin_labels(cut_points):
+    cut_points = [_format_cut_point(cut_point) for cut_point in cut_points]
+    bin_labels = ['<={}'.format(cut_points[0])]
+    for lower, upper in zip(cut_points, cut_points[1:]):
+        bin_labels.append('>{}<={}'.format(lower, upper))
+    bin_labels.append('>{}'.format(cut_points[-1]))
+    return bin_labels
+
+
 def transform_continuos_data(
         continuous_attribute_indexes, discrete_values_dict,
         input_file, exclude_flag
 ):
+    bin_labels_dict = {
+        attribute_index: _create_bin_labels(cut_points)
+        for attribute_index, cut_points in discrete_values_dict.items()
+    }
     for line in input_file:
         if not _has_exclude_flag(line, exclude_flag):
             for attribute_index in continuous_attribute_indexes:
-                continuous_attribute = line[attribute_index]
-                discrete_value = discrete_values_dict[attribute_index]
-                if continuous_attribute > discrete_value:
-                    new_value = '>{}'.format(discrete_value)
-                else:
-                    new_value = '<={}'.format(discrete_value)
-                line[attribute_index] = new_value
+                bin_index = bisect_left(
+                    discrete_values_dict[attribute_index],
+                    float(line[attribute_index])
+                )
+                line[attribute_index] = bin_labels_dict[attribute_index][
+                    bin_index
+                ]
             yield ','.join(line)
 
 
+def _select(values, k):
+    # Quickselect: the k-th smallest value in expected linear time,
+    # without sorting the column.
+    values = list(values)
+    while True:
+        pivot = values[randrange(len(values))]
+        lower = [value for value in values if value < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        equal_count = values.count(pivot)
+        if k < len(lower) + equal_count:
+            return pivot
+        k -= len(lower) + equal_count
+        values = [value for value in values if value > pivot]
+
+
 def calculate_discrete_values(continuous_attribute_indexes, exclude_flag,
-                              input_file):
+                              input_file, bins=2):
     discrete_dict = {}
     for attributes_index in continuous_attribute_indexes:
-        discrete_dict[attributes_index] = []
+        discrete_dict[attributes_index] = array('d')
     excluded_lines = 0
     for line in input_file:
         if not _has_exclude_flag(line, exclude_flag):
             for continuous_attribute_index in continuous_attribute_indexes:
                 discrete_dict[continuous_attribute_index].append(
-                    line[continuous_attribute_index]
+                    float(line[continuous_attribute_index])
                 )
         else:
             excluded_lines += 1
     for attribute in discrete_dict.keys():
-        discrete_dict[attribute].sort()
-        middle_index = int(len(discrete_dict[attribute])/2)
-        discrete_dict[attribute] = discrete_dict[attribute][middle_index]
+        values = discrete_dict[attribute]
+        cut_points = set()
+        for bin_index in range(1, bins):
+            cut_points.add(_select(values, int(len(values) * bin_index / bins)))
+        discrete_dict[attribute] = sorted(cut_points)
     return discrete_dict, excluded_lines
 
 
@@ -58,16 +105,20 @@ def write_output_file(output_file_path, output_file_generator):
             output.write(line + '\n')
 
 
-def run(input_file_path, output_file_path, unknown_flag):
-    adult_data = read_csv_file(input_file_path)
+def run(input_file_path, output_file_path, unknown_flag, bins=2):
     continuous_attributes = [0, 2, 4, 10, 11, 12]
     discrete_values_dict, excluded_lines = calculate_discrete_values(
-        continuous_attributes, unknown_flag, adult_data
+        continuous_attributes, unknown_flag, _iter_lines(input_file_path),
+        bins
     )
     output_file_generator = transform_continuos_data(
-        continuous_attributes, discrete_values_dict, adult_data, unknown_flag
+        continuous_attributes, discrete_values_dict,
+        _iter_lines(input_file_path), unknown_flag
     )
     write_output_file(output_file_path, output_file_generator)
+    write_dataset_cache(
+        output_file_path, *read_encoded_columns(output_file_path)
+    )
 
 
 if __name__ == '__main__':
@@ -76,5 +127,6 @@ if __name__ == '__main__':
     input_file_path = sys.argv[1]
     output_file_path = sys.argv[2]
     unknown_flag = sys.argv[3]
+    bins = int(sys.argv[4]) if len(sys.argv) > 4 else 2
 
-    run(input_file_path, output_file_path, unknown_flag)
+    run(input_file_path, output_file_path, unknown_flag, bins)